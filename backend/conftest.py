@@ -0,0 +1 @@
+# 使 tests 可以直接导入 services 包（pytest 会把本文件所在目录加入 sys.path）
@@ -1,15 +1,20 @@
 from fastapi import FastAPI, UploadFile, File, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import StreamingResponse
-from pydantic import BaseModel
+from fastapi.responses import StreamingResponse, ORJSONResponse, Response
+from pydantic import BaseModel, ConfigDict, TypeAdapter
 from typing import Optional, List
 from contextlib import asynccontextmanager
+from datetime import datetime
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
 import pandas as pd
-import pickle
-import io
+import asyncio
+import os
 import uuid
-import json
+import hashlib
 import warnings
+import orjson
 
 # 抑制 openpyxl 的扩展警告
 warnings.filterwarnings("ignore", category=UserWarning, module="openpyxl")
@@ -18,12 +23,33 @@ from slowapi import Limiter, _rate_limit_exceeded_handler
 from slowapi.util import get_remote_address
 from slowapi.errors import RateLimitExceeded
 
-from services.llm_service import chat_with_context_multi_files, stream_chat_multi_files, extract_chart_config
+from services.logging_service import setup_logging, stop_logging
+from services.llm_service import chat_with_context_multi_files, stream_chat_multi_files, StreamingChartExtractor
 from services.database import init_db, MessageRole
+from services.dataframe_service import (
+    DataFrameLRUCache,
+    dumps_dataframe,
+    loads_dataframe,
+    parse_file,
+    read_sheet_names,
+    read_parquet_cache,
+    write_parquet_cache,
+    dumps_parquet,
+    loads_parquet,
+    dumps_meta,
+    dumps_preview,
+    json_default,
+)
 from services.chat_history_service import ChatHistoryService, FileStorageService, ChartService
 from services.redis_service import (
     get_cached_dataframe,
     set_cached_dataframe,
+    get_cached_sheet_names,
+    set_cached_sheet_names,
+    get_cached_summary,
+    set_cached_summary,
+    get_cached_llm_contexts,
+    set_cached_llm_context,
     delete_cached_dataframe,
     check_redis_connection,
     close_redis,
@@ -33,9 +59,46 @@ from services.redis_service import (
 limiter = Limiter(key_func=get_remote_address)
 
 
-def clean_dataframe_for_llm(df: pd.DataFrame) -> str:
+# 发送给 LLM 的样本行数（只需字段信息和样本，无需整表）
+LLM_CONTEXT_MAX_ROWS = int(os.getenv("LLM_CONTEXT_MAX_ROWS", 50))
+# 样本数据 CSV 的字符预算（宽表或长文本单元格时减少样本行数，控制输入 token 数）
+LLM_CONTEXT_MAX_CHARS = int(os.getenv("LLM_CONTEXT_MAX_CHARS", 20000))
+# LLM 上下文的格式版本，修改 build_llm_context 的输出格式时递增，使旧缓存失效
+LLM_CONTEXT_FORMAT_VERSION = 2
+# LLM 上下文缓存 key 的后缀：格式版本 + 行数 + 字符预算，任一配置变化都不会命中旧缓存
+LLM_CONTEXT_CACHE_VARIANT = f"v{LLM_CONTEXT_FORMAT_VERSION}:{LLM_CONTEXT_MAX_ROWS}:{LLM_CONTEXT_MAX_CHARS}"
+# LLM 上下文缓存条数上限
+LLM_CONTEXT_CACHE_SIZE = 256
+
+
+
+class LRUCache(OrderedDict):
+    """按条数淘汰的简单 LRU 缓存"""
+
+    def __init__(self, maxsize: int):
+        super().__init__()
+        self.maxsize = maxsize
+
+    def get(self, key, default=None):
+        if key in self:
+            self.move_to_end(key)
+            return self[key]
+        return default
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self.move_to_end(key)
+        if len(self) > self.maxsize:
+            self.popitem(last=False)
+
+
+# LLM 上下文缓存：(数据源ID, 样本行数) -> (列名, 上下文文本)
+llm_context_cache: LRUCache = LRUCache(LLM_CONTEXT_CACHE_SIZE)
+
+
+def clean_dataframe_for_llm(df: pd.DataFrame) -> pd.DataFrame:
     """
-    清洗 DataFrame 并转换为字符串，用于传递给 LLM。
+    清洗 DataFrame，用于传递给 LLM。
     移除回车符、换行符等特殊字符，避免图表图例出现乱码。
     """
     # 复制 DataFrame 避免修改原始数据
@@ -45,16 +108,98 @@ def clean_dataframe_for_llm(df: pd.DataFrame) -> str:
     for col in df_clean.columns:
         if df_clean[col].dtype == 'object':
             # 清洗字符串：移除 \r\n，替换多余空格
-            df_clean[col] = df_clean[col].astype(str).str.replace(r'[\r\n]+', ' ', regex=True)
+            df_clean[col] = df_clean[col].fillna("").astype(str).str.replace(r'[\r\n]+', ' ', regex=True)
             df_clean[col] = df_clean[col].str.replace(r'\s+', ' ', regex=True)
             df_clean[col] = df_clean[col].str.strip()
 
-    return df_clean.to_string(index=False)
+    return df_clean
+
+
+# 统计摘要中浮点数的格式（6 位有效数字，结果稳定且更短）
+SUMMARY_FLOAT_FORMAT = "%.6g"
+
+
+def build_summary(df: pd.DataFrame) -> str:
+    """
+    全表统计摘要（describe），样本行之外的数据分布信息，无数据时返回空字符串
+    """
+    if df.empty:
+        return ""
+    # describe 的 top 等取值来自原始数据，同样需要清洗换行符（摘要只有几行，清洗开销很小）
+    summary = clean_dataframe_for_llm(df.describe(include="all").dropna(how="all"))
+    return f"统计摘要:\n{summary.to_csv(na_rep='', float_format=SUMMARY_FLOAT_FORMAT)}\n"
+
+
+def build_sample_csv(df: pd.DataFrame, max_rows: int, max_chars: int = LLM_CONTEXT_MAX_CHARS) -> tuple[int, str]:
+    """
+    前 max_rows 行样本的 CSV：超过字符预算时按比例减少行数（至少保留 1 行），
+    结果只取决于数据本身，同一数据源每次生成的样本相同
+
+    Returns:
+        (样本行数, CSV 文本)
+    """
+    sample_df = clean_dataframe_for_llm(df.head(max_rows))
+    sample_csv = sample_df.to_csv(index=False, na_rep='')
+    while len(sample_csv) > max_chars and len(sample_df) > 1:
+        # 按超出比例估算能放下的行数，每次至少减少一行
+        rows = max(1, min(len(sample_df) - 1, len(sample_df) * max_chars // len(sample_csv)))
+        sample_df = sample_df.head(rows)
+        sample_csv = sample_df.to_csv(index=False, na_rep='')
+    return len(sample_df), sample_csv
+
+
+def build_llm_context(df: pd.DataFrame, max_rows: int = LLM_CONTEXT_MAX_ROWS) -> str:
+    """
+    构建传递给 LLM 的数据上下文：总行数、字段类型、全表统计摘要和前 max_rows 行样本（CSV，受字符预算限制）
+    """
+    sample_rows, sample_csv = build_sample_csv(df, max_rows)
+    dtypes = "\n".join(f"- {col}: {dtype}" for col, dtype in df.dtypes.items())
+    return (
+        f"总行数: {len(df)}\n"
+        f"字段类型:\n{dtypes}\n\n"
+        f"{build_summary(df)}"
+        f"前 {sample_rows} 行数据 (CSV):\n"
+        f"{sample_csv}"
+    )
+
+
+# 文件解析进程池（pandas/openpyxl 解析是 CPU 密集型，放在子进程中避免阻塞事件循环）
+PARSE_WORKERS = int(os.getenv("PARSE_WORKERS", 2))
+parse_pool: Optional[ProcessPoolExecutor] = None
+
+
+async def parse_file_async(
+    source,
+    file_type: str,
+    sheet_name: Optional[str] = None,
+    default_to_first_sheet: bool = False
+) -> tuple[pd.DataFrame, bytes, List[str], Optional[str]]:
+    """
+    在解析进程池中解析文件
+
+    Returns:
+        (DataFrame, 序列化结果（可直接写入 Redis）, sheet 名称列表, 实际解析的 sheet)
+    """
+    loop = asyncio.get_running_loop()
+    df_bytes, sheet_names, selected_sheet = await loop.run_in_executor(
+        parse_pool, parse_file, source, file_type, sheet_name, default_to_first_sheet
+    )
+    # 解压和 Arrow 转换在线程中执行，不阻塞事件循环
+    df = await asyncio.to_thread(loads_dataframe, df_bytes)
+    return df, df_bytes, sheet_names, selected_sheet
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """应用生命周期管理"""
+    global parse_pool
+    # 日志通过后台线程输出
+    setup_logging()
+    # 使用 spawn 启动解析进程，避免 fork 带有事件循环和连接池的进程
+    parse_pool = ProcessPoolExecutor(
+        max_workers=PARSE_WORKERS,
+        mp_context=multiprocessing.get_context("spawn")
+    )
     # 启动时初始化数据库
     await init_db()
     # 检查 Redis 连接
@@ -66,9 +211,16 @@ async def lifespan(app: FastAPI):
     yield
     # 关闭时清理资源
     await close_redis()
+    parse_pool.shutdown(cancel_futures=True)
+    stop_logging()
 
 
-app = FastAPI(title="ChatExcel API", version="1.0.0", lifespan=lifespan)
+app = FastAPI(
+    title="ChatExcel API",
+    version="1.0.0",
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse,
+)
 
 # 添加限流异常处理
 app.state.limiter = limiter
@@ -91,7 +243,19 @@ async def health_check():
     return {"status": "healthy", "service": "chatexcel-backend"}
 
 # 本地内存缓存（Redis 不可用时的降级方案）
-local_file_cache: dict[str, pd.DataFrame] = {}
+# 按 DataFrame 内存占用淘汰，默认上限 512 MB；条目过期时间与 Redis 缓存一致
+CACHE_MAX_BYTES = int(os.getenv("CACHE_MAX_BYTES", 512 * 1024 * 1024))
+LOCAL_CACHE_TTL = int(os.getenv("LOCAL_CACHE_TTL", 3600))
+local_file_cache = DataFrameLRUCache(CACHE_MAX_BYTES, ttl=LOCAL_CACHE_TTL)
+
+# 数据库中 Parquet 数据的大小上限（MEDIUMBLOB 最大 16 MB）
+PARQUET_BLOB_MAX_BYTES = 16777215
+
+# sheet 名称缓存：file_id -> sheet 名称列表（文件上传后不可变）
+sheet_names_cache: LRUCache = LRUCache(256)
+
+# 文件名缓存：file_id -> 文件名
+filename_cache: LRUCache = LRUCache(1024)
 
 
 def get_client_id(request: Request) -> str:
@@ -125,12 +289,31 @@ class FileMetadata(BaseModel):
     selected_sheets: List[str] = []
 
 
+# 文件元信息列表批量转换为字典（在 pydantic-core 中一次完成）
+file_metadata_adapter = TypeAdapter(List[FileMetadata])
+
+
 class CreateSessionRequest(BaseModel):
     title: Optional[str] = None
     file_ids: Optional[List[str]] = None  # 改为支持多个文件
     file_metadata: Optional[List[FileMetadata]] = None  # 文件元信息
 
 
+class SessionListItem(BaseModel):
+    """会话列表项"""
+    model_config = ConfigDict(from_attributes=True)
+
+    id: str
+    title: Optional[str]
+    file_ids: Optional[List[str]]
+    created_at: datetime
+    updated_at: datetime
+
+
+# 会话列表批量校验/序列化（在 pydantic-core 中一次完成）
+session_list_adapter = TypeAdapter(List[SessionListItem])
+
+
 class SessionResponse(BaseModel):
     id: str
     title: Optional[str]
@@ -161,28 +344,28 @@ async def upload_file(request: Request, file: UploadFile = File(...), sheet_name
     if file_ext not in allowed_extensions:
         raise HTTPException(status_code=400, detail="只支持 Excel (.xlsx, .xls, .xlsm) 和 CSV (.csv) 文件")
 
-    try:
-        content = await file.read()
-        sheet_names = []
-        selected_sheet = None
-
-        # 解析文件
-        if file_ext == ".csv":
-            df = pd.read_csv(io.BytesIO(content))
-        else:
-            # 获取所有 sheet 名称
-            excel_file = pd.ExcelFile(io.BytesIO(content))
-            sheet_names = excel_file.sheet_names
-
-            # 使用指定的 sheet 或默认第一个
-            selected_sheet = sheet_name if sheet_name and sheet_name in sheet_names else sheet_names[0]
-            df = pd.read_excel(io.BytesIO(content), sheet_name=selected_sheet)
+    # 生成文件ID（如果选择了不同的 sheet，生成新的 ID）
+    file_id = str(uuid.uuid4())
 
-        # 处理 NaN 值，替换为 None（JSON 可序列化）
-        df = df.fillna("")
+    try:
+        # 上传内容分块写入本地副本，解析进程直接读取磁盘文件，无需跨进程传输文件内容
+        file_path = await FileStorageService.store_upload(file_id, file.file)
 
-        # 生成文件ID（如果选择了不同的 sheet，生成新的 ID）
-        file_id = str(uuid.uuid4())
+        # 解析文件（Excel 使用指定的 sheet 或默认第一个）
+        df, df_bytes, sheet_names, selected_sheet = await parse_file_async(
+            file_path, file_ext.lstrip("."), sheet_name, default_to_first_sheet=True
+        )
+        content = await asyncio.to_thread(read_file_bytes, file_path)
+
+        # 解析结果序列化为 Parquet：写入本地缓存，默认 sheet 的结果同时持久化到数据库
+        parquet_bytes = await asyncio.to_thread(dumps_parquet, df)
+        meta_json, preview_json = dumps_meta(df), dumps_preview(df)
+        is_default_sheet = not sheet_names or selected_sheet == sheet_names[0]
+        store_parquet = (
+            is_default_sheet
+            and parquet_bytes is not None
+            and len(parquet_bytes) <= PARQUET_BLOB_MAX_BYTES
+        )
 
         # 存储到 MySQL
         await FileStorageService.save_file(
@@ -191,19 +374,29 @@ async def upload_file(request: Request, file: UploadFile = File(...), sheet_name
             data=content,  # 存储原始文件内容
             columns=df.columns.tolist(),
             rows=len(df),
-            file_type=file_ext.lstrip(".")
+            file_type=file_ext.lstrip("."),
+            sheet_names=sheet_names or None,
+            data_parquet=parquet_bytes if store_parquet else None,
+            preview_json=preview_json.decode() if is_default_sheet else None
         )
+        if sheet_names:
+            sheet_names_cache[file_id] = sheet_names
+            await set_cached_sheet_names(file_id, sheet_names)
 
         # 缓存 DataFrame 到 Redis（优先）或本地
         # 缓存 key 包含 sheet 名称
         cache_key = f"{file_id}:{selected_sheet}" if selected_sheet else file_id
-        try:
-            await set_cached_dataframe(cache_key, pickle.dumps(df))
-        except Exception:
-            local_file_cache[cache_key] = df
+        if parquet_bytes is not None:
+            await asyncio.to_thread(
+                write_parquet_cache, df, FileStorageService.get_parquet_path(file_id, selected_sheet), parquet_bytes
+            )
+        if not await set_cached_dataframe(cache_key, df_bytes):
+            local_file_cache.set(cache_key, df)
+        await set_cached_summary(cache_key, meta_json, preview_json)
+        await FileStorageService.prune_local_storage()
 
-        # 预览数据
-        preview_df = df.head(5).copy()
+        # 预览数据（只对预览行处理 NaN，保留原始 DataFrame 的数值类型）
+        preview_df = df.head(5).fillna("")
         preview = preview_df.to_dict(orient="records")
 
         return {
@@ -217,82 +410,168 @@ async def upload_file(request: Request, file: UploadFile = File(...), sheet_name
         }
 
     except Exception as e:
+        FileStorageService.remove_local_copy(file_id)
         raise HTTPException(status_code=500, detail=f"文件解析失败: {str(e)}")
 
 
+def read_file_bytes(path: str) -> bytes:
+    """读取本地文件内容（用于写入数据库）"""
+    with open(path, "rb") as f:
+        return f.read()
+
+
 async def get_dataframe(file_id: str, sheet_name: Optional[str] = None) -> pd.DataFrame:
     """从缓存或数据库获取 DataFrame（优先 Redis，降级到本地缓存）"""
     # 构建缓存 key（包含 sheet 名称）
     cache_key = f"{file_id}:{sheet_name}" if sheet_name else file_id
 
     # 1. 先检查本地缓存
-    if cache_key in local_file_cache:
-        return local_file_cache[cache_key]
+    df = local_file_cache.get(cache_key)
+    if df is not None:
+        return df
 
     # 2. 检查 Redis 缓存
     try:
         cached_data = await get_cached_dataframe(cache_key)
         if cached_data:
-            df = pickle.loads(cached_data)
+            # 解压和 Arrow 转换在线程中执行，不阻塞事件循环
+            df = await asyncio.to_thread(loads_dataframe, cached_data)
             return df
     except Exception:
         pass
 
-    # 3. 从数据库加载
-    uploaded_file = await FileStorageService.get_file(file_id)
-    if not uploaded_file:
-        raise HTTPException(status_code=404, detail=f"文件 {file_id} 不存在")
+    # 3. 检查本地 Parquet 缓存（比重新解析 Excel 快得多，且保留列类型）
+    parquet_path = FileStorageService.get_parquet_path(file_id, sheet_name)
+    df = await asyncio.to_thread(read_parquet_cache, parquet_path)
+
+    # 4. 从数据库加载并解析文件
+    if df is None:
+        uploaded_file = await FileStorageService.get_file(file_id, with_parquet=True)
+        if not uploaded_file:
+            raise HTTPException(status_code=404, detail=f"文件 {file_id} 不存在")
+
+        default_sheet = (uploaded_file.sheet_names or [None])[0]
+        parquet_bytes = None
+        if uploaded_file.data_parquet and (not sheet_name or sheet_name == default_sheet):
+            # 默认 sheet 使用上传时持久化的 Parquet，无需重新解析
+            parquet_bytes = uploaded_file.data_parquet
+            df = await asyncio.to_thread(loads_parquet, parquet_bytes)
+            df_bytes = await asyncio.to_thread(dumps_dataframe, df)
+        else:
+            # 解析文件（读取本地副本，Excel 文件支持指定 sheet）
+            file_path = await FileStorageService.get_file_path(uploaded_file)
+            df, df_bytes, _, _ = await parse_file_async(file_path, uploaded_file.file_type, sheet_name)
+        await asyncio.to_thread(write_parquet_cache, df, parquet_path, parquet_bytes)
+        await FileStorageService.prune_local_storage()
+    else:
+        df_bytes = await asyncio.to_thread(dumps_dataframe, df)
+
+    # 5. 写入缓存（优先 Redis，写入失败时降级到本地缓存）
+    if not await set_cached_dataframe(cache_key, df_bytes):
+        local_file_cache.set(cache_key, df)
+
+    return df
+
 
-    # 解析文件
+async def get_sheet_names(uploaded_file) -> List[str]:
+    """获取 Excel 文件的 sheet 名称（本地缓存 -> 数据库字段 -> Redis -> 解析文件）"""
     if uploaded_file.file_type == "csv":
-        df = pd.read_csv(io.BytesIO(uploaded_file.data))
-    else:
-        # Excel 文件支持指定 sheet
-        if sheet_name:
-            df = pd.read_excel(io.BytesIO(uploaded_file.data), sheet_name=sheet_name)
-        else:
-            df = pd.read_excel(io.BytesIO(uploaded_file.data))
+        return []
 
-    df = df.fillna("")
+    sheet_names = sheet_names_cache.get(uploaded_file.id)
+    if sheet_names is not None:
+        return sheet_names
 
-    # 4. 写入缓存（优先 Redis）
-    try:
-        await set_cached_dataframe(cache_key, pickle.dumps(df))
-    except Exception:
-        local_file_cache[cache_key] = df
+    sheet_names = uploaded_file.sheet_names or await get_cached_sheet_names(uploaded_file.id)
+    if not sheet_names:
+        # 旧数据没有保存 sheet 名称，解析一次后写入缓存
+        file_path = await FileStorageService.get_file_path(uploaded_file)
+        sheet_names = await asyncio.to_thread(read_sheet_names, file_path)
+        await set_cached_sheet_names(uploaded_file.id, sheet_names)
 
-    return df
+    sheet_names_cache[uploaded_file.id] = sheet_names
+    return sheet_names
+
+
+async def get_sheet_summary(file_id: str, sheet_name: Optional[str]) -> tuple[dict, bytes]:
+    """
+    获取列名、行数和数据预览 JSON（优先读取缓存，命中时无需加载 DataFrame）
+    """
+    cache_key = f"{file_id}:{sheet_name}" if sheet_name else file_id
+    meta_json, preview_json = await get_cached_summary(cache_key)
+    if meta_json is None or preview_json is None:
+        df = await get_dataframe(file_id, sheet_name)
+        meta_json, preview_json = dumps_meta(df), dumps_preview(df)
+        await set_cached_summary(cache_key, meta_json, preview_json)
+    return orjson.loads(meta_json), preview_json
+
+
+def json_response(content: dict, headers: Optional[dict] = None) -> Response:
+    """构建 JSON 响应，预计算的预览以 orjson.Fragment 原样嵌入"""
+    return Response(
+        content=orjson.dumps(content, default=json_default),
+        media_type="application/json",
+        headers=headers
+    )
+
+
+def make_etag(*parts: str) -> str:
+    """根据给定内容生成 ETag"""
+    digest = hashlib.blake2b(digest_size=8)
+    for part in parts:
+        digest.update(part.encode())
+        digest.update(b"\0")
+    return f'"{digest.hexdigest()}"'
+
+
+def etag_matches(request: Request, etag: str) -> bool:
+    """检查请求的 If-None-Match 是否命中 ETag"""
+    if_none_match = request.headers.get("if-none-match")
+    if not if_none_match:
+        return False
+    return any(tag.strip().removeprefix("W/") == etag for tag in if_none_match.split(","))
 
 
 @app.get("/api/files/{file_id}")
-async def get_file_info(file_id: str, sheet_name: Optional[str] = None):
+async def get_file_info(request: Request, file_id: str, sheet_name: Optional[str] = None):
     """
     获取已上传文件的信息
+    文件上传后不可变，ETag 只由 file_id 和 sheet 名称决定，命中时直接返回 304
     """
-    df = await get_dataframe(file_id, sheet_name)
-    preview_df = df.head(10).fillna("")
+    etag = make_etag(file_id, sheet_name or "")
+    cache_headers = {"ETag": etag, "Cache-Control": "private, max-age=3600"}
+    if etag_matches(request, etag):
+        return Response(status_code=304, headers=cache_headers)
 
     # 获取文件元信息
     uploaded_file = await FileStorageService.get_file(file_id)
+    if not uploaded_file:
+        raise HTTPException(status_code=404, detail=f"文件 {file_id} 不存在")
 
     # 获取所有 sheet 名称（Excel 文件）
     sheet_names = []
-    if uploaded_file and uploaded_file.file_type in ["xlsx", "xls", "xlsm"]:
+    if uploaded_file.file_type in ["xlsx", "xls", "xlsm"]:
         try:
-            excel_file = pd.ExcelFile(io.BytesIO(uploaded_file.data))
-            sheet_names = excel_file.sheet_names
+            sheet_names = await get_sheet_names(uploaded_file)
         except Exception:
             pass
 
-    return {
+    if uploaded_file.preview_json and (not sheet_name or sheet_name == (sheet_names or [None])[0]):
+        # 默认 sheet 的列名、行数和预览在上传时已保存，无需加载 DataFrame
+        meta = {"columns": uploaded_file.columns, "rows": uploaded_file.rows}
+        preview_json = uploaded_file.preview_json
+    else:
+        meta, preview_json = await get_sheet_summary(file_id, sheet_name)
+
+    return json_response({
         "file_id": file_id,
-        "filename": uploaded_file.filename if uploaded_file else None,
-        "columns": df.columns.tolist(),
-        "rows": len(df),
-        "preview": preview_df.to_dict(orient="records"),
+        "filename": uploaded_file.filename,
+        "columns": meta["columns"],
+        "rows": meta["rows"],
+        "preview": orjson.Fragment(preview_json),
         "sheet_names": sheet_names,
         "selected_sheet": sheet_name or (sheet_names[0] if sheet_names else None)
-    }
+    }, headers=cache_headers)
 
 
 @app.post("/api/files/{file_id}/switch-sheet")
@@ -309,8 +588,8 @@ async def switch_sheet(file_id: str, sheet_name: str):
 
     # 验证 sheet 名称
     try:
-        excel_file = pd.ExcelFile(io.BytesIO(uploaded_file.data))
-        if sheet_name not in excel_file.sheet_names:
+        sheet_names = await get_sheet_names(uploaded_file)
+        if sheet_name not in sheet_names:
             raise HTTPException(status_code=400, detail=f"Sheet '{sheet_name}' 不存在")
     except HTTPException:
         raise
@@ -318,18 +597,17 @@ async def switch_sheet(file_id: str, sheet_name: str):
         raise HTTPException(status_code=500, detail=f"解析文件失败: {str(e)}")
 
     # 获取指定 sheet 的数据
-    df = await get_dataframe(file_id, sheet_name)
-    preview_df = df.head(10).fillna("")
+    meta, preview_json = await get_sheet_summary(file_id, sheet_name)
 
-    return {
+    return json_response({
         "file_id": file_id,
         "filename": uploaded_file.filename,
-        "columns": df.columns.tolist(),
-        "rows": len(df),
-        "preview": preview_df.to_dict(orient="records"),
-        "sheet_names": excel_file.sheet_names,
+        "columns": meta["columns"],
+        "rows": meta["rows"],
+        "preview": orjson.Fragment(preview_json),
+        "sheet_names": sheet_names,
         "selected_sheet": sheet_name
-    }
+    })
 
 
 class MultiSheetRequest(BaseModel):
@@ -352,8 +630,8 @@ async def select_multiple_sheets(file_id: str, req: MultiSheetRequest):
 
     # 验证所有 sheet 名称
     try:
-        excel_file = pd.ExcelFile(io.BytesIO(uploaded_file.data))
-        invalid_sheets = [s for s in req.sheet_names if s not in excel_file.sheet_names]
+        sheet_names = await get_sheet_names(uploaded_file)
+        invalid_sheets = [s for s in req.sheet_names if s not in sheet_names]
         if invalid_sheets:
             raise HTTPException(status_code=400, detail=f"Sheet 不存在: {', '.join(invalid_sheets)}")
     except HTTPException:
@@ -361,12 +639,11 @@ async def select_multiple_sheets(file_id: str, req: MultiSheetRequest):
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"解析文件失败: {str(e)}")
 
-    # 加载所有选中的 sheet
-    sheets_data = []
-    for sheet_name in req.sheet_names:
-        df = await get_dataframe(file_id, sheet_name)
-        preview_df = df.head(10).fillna("")
+    # 并发加载所有选中的 sheet
+    summaries = await asyncio.gather(*(get_sheet_summary(file_id, sheet_name) for sheet_name in req.sheet_names))
 
+    sheets_data = []
+    for sheet_name, (meta, preview_json) in zip(req.sheet_names, summaries):
         # 使用 file_id:sheet_name 作为数据源标识
         data_source_id = f"{file_id}:{sheet_name}"
 
@@ -374,21 +651,122 @@ async def select_multiple_sheets(file_id: str, req: MultiSheetRequest):
             "data_source_id": data_source_id,
             "file_id": file_id,
             "sheet_name": sheet_name,
-            "columns": df.columns.tolist(),
-            "rows": len(df),
-            "preview": preview_df.to_dict(orient="records"),
+            "columns": meta["columns"],
+            "rows": meta["rows"],
+            "preview": orjson.Fragment(preview_json),
         })
 
-    return {
+    return json_response({
         "file_id": file_id,
         "filename": uploaded_file.filename,
-        "sheet_names": excel_file.sheet_names,
+        "sheet_names": sheet_names,
         "selected_sheets": sheets_data
-    }
+    })
 
 
 # ==================== 多轮对话 API ====================
 
+def parse_data_source_id(data_source_id: str) -> tuple[str, Optional[str]]:
+    """解析 file_id:sheet_name 格式的数据源ID"""
+    if ":" in data_source_id:
+        actual_file_id, sheet_name = data_source_id.split(":", 1)
+        return actual_file_id, sheet_name
+    return data_source_id, None
+
+
+async def get_filenames(file_ids: List[str]) -> dict[str, str]:
+    """批量获取文件名（文件名上传后不可变，已缓存的文件跳过数据库查询）"""
+    filenames = {}
+    missing_ids = []
+    for file_id in dict.fromkeys(file_ids):
+        filename = filename_cache.get(file_id)
+        if filename is None:
+            missing_ids.append(file_id)
+        else:
+            filenames[file_id] = filename
+
+    if missing_ids:
+        for file_id, filename in (await FileStorageService.get_filenames(missing_ids)).items():
+            filename_cache[file_id] = filename
+            filenames[file_id] = filename
+
+    return filenames
+
+
+async def build_and_cache_llm_context(data_source_id: str) -> Optional[tuple[list, str]]:
+    """加载 DataFrame 构建 (列名, LLM 上下文文本) 并写入 Redis，无法加载时返回 None"""
+    try:
+        df = await get_dataframe(*parse_data_source_id(data_source_id))
+    except Exception:
+        return None
+    context = (df.columns.tolist(), build_llm_context(df))
+    await set_cached_llm_context(
+        data_source_id,
+        LLM_CONTEXT_CACHE_VARIANT,
+        orjson.dumps({"columns": context[0], "data": context[1]}, default=json_default),
+    )
+    return context
+
+
+async def get_llm_contexts(data_source_ids: List[str]) -> List[Optional[tuple[list, str]]]:
+    """
+    批量获取数据源的 (列名, LLM 上下文文本)，无法加载的位置为 None。
+    文件内容不可变：依次查本地 LRU、Redis（单次 MGET），都未命中时才并发加载 DataFrame
+    """
+    contexts = [llm_context_cache.get((data_source_id, LLM_CONTEXT_CACHE_VARIANT)) for data_source_id in data_source_ids]
+    missing = [i for i, context in enumerate(contexts) if context is None]
+    if not missing:
+        return contexts
+
+    cached_jsons = await get_cached_llm_contexts([data_source_ids[i] for i in missing], LLM_CONTEXT_CACHE_VARIANT)
+    to_build = []
+    for i, context_json in zip(missing, cached_jsons):
+        if context_json:
+            context = orjson.loads(context_json)
+            contexts[i] = (context["columns"], context["data"])
+        else:
+            to_build.append(i)
+
+    if to_build:
+        built = await asyncio.gather(*(build_and_cache_llm_context(data_source_ids[i]) for i in to_build))
+        for i, context in zip(to_build, built):
+            contexts[i] = context
+
+    for i in missing:
+        if contexts[i] is not None:
+            llm_context_cache[(data_source_ids[i], LLM_CONTEXT_CACHE_VARIANT)] = contexts[i]
+    return contexts
+
+
+async def load_files_data(file_ids: List[str]) -> List[dict]:
+    """并发加载多个数据源（支持 file_id:sheet_name 格式），跳过无法加载的文件"""
+    parsed_ids = [parse_data_source_id(data_source_id) for data_source_id in file_ids]
+    # 文件名查询与各数据源的上下文加载互不依赖，一起并发执行
+    filenames, contexts = await asyncio.gather(
+        get_filenames([actual_file_id for actual_file_id, _ in parsed_ids]),
+        get_llm_contexts(file_ids)
+    )
+
+    files_data = []
+    for data_source_id, (actual_file_id, sheet_name), context in zip(file_ids, parsed_ids, contexts):
+        if context is None:
+            continue
+        columns, data = context
+
+        # 构建显示名称（包含 sheet 名称）
+        filename = filenames.get(actual_file_id, actual_file_id)
+        if sheet_name:
+            filename = f"{filename} [Sheet: {sheet_name}]"
+
+        files_data.append({
+            "file_id": data_source_id,
+            "filename": filename,
+            "columns": columns,
+            "data": data
+        })
+    return files_data
+
+
 @app.post("/api/sessions", response_model=SessionResponse)
 async def create_session(req: CreateSessionRequest, request: Request):
     """创建新的对话会话"""
@@ -397,7 +775,7 @@ async def create_session(req: CreateSessionRequest, request: Request):
     # 转换文件元信息为字典格式
     file_metadata_dicts = None
     if req.file_metadata:
-        file_metadata_dicts = [fm.model_dump() for fm in req.file_metadata]
+        file_metadata_dicts = file_metadata_adapter.dump_python(req.file_metadata)
 
     session = await ChatHistoryService.create_session(
         file_ids=req.file_ids,
@@ -431,17 +809,9 @@ async def list_sessions(
         search=search,
         client_id=client_id
     )
+    items = session_list_adapter.validate_python(sessions, from_attributes=True)
     return {
-        "items": [
-            {
-                "id": s.id,
-                "title": s.title,
-                "file_ids": s.file_ids,
-                "created_at": s.created_at.isoformat(),
-                "updated_at": s.updated_at.isoformat()
-            }
-            for s in sessions
-        ],
+        "items": session_list_adapter.dump_python(items, mode="json"),
         "total": total,
         "page": page,
         "limit": limit,
@@ -468,7 +838,7 @@ async def get_session(session_id: str):
                 "id": m.id,
                 "role": m.role.value,
                 "content": m.content,
-                "chart_config": json.loads(m.chart_config) if m.chart_config else None,
+                "chart_config": m.chart_config,
                 "created_at": m.created_at.isoformat()
             }
             for m in session.messages
@@ -502,21 +872,32 @@ class UpdateFileMetadataRequest(BaseModel):
 @app.put("/api/sessions/{session_id}/file-metadata")
 async def update_session_file_metadata(session_id: str, req: UpdateFileMetadataRequest):
     """更新会话的文件元信息（如 sheet 选择变化）"""
-    file_metadata_dicts = [fm.model_dump() for fm in req.file_metadata]
+    file_metadata_dicts = file_metadata_adapter.dump_python(req.file_metadata)
     success = await ChatHistoryService.update_session_file_metadata(session_id, file_metadata_dicts)
     if not success:
         raise HTTPException(status_code=404, detail="会话不存在")
     return {"message": "文件元信息已更新"}
 
 
+def make_session_title(message: str) -> str:
+    """用第一条用户消息生成会话标题"""
+    return message[:50] + ("..." if len(message) > 50 else "")
+
+
 @app.post("/api/chat", response_model=ChatResponse)
 async def chat(req: ChatRequest):
     """多轮对话接口 - 支持多文件"""
-    # 获取会话
-    session = await ChatHistoryService.get_session(req.session_id)
+    # 获取会话（不加载消息）和历史消息
+    session, history_messages = await asyncio.gather(
+        ChatHistoryService.get_session_meta(req.session_id),
+        ChatHistoryService.get_history_messages(req.session_id),
+    )
     if not session:
         raise HTTPException(status_code=404, detail="会话不存在")
 
+    # 在写入任何消息之前判断是否为第一条消息
+    is_first_message = not history_messages
+
     # 确定要使用的文件ID列表
     file_ids = req.file_ids or session.file_ids or []
 
@@ -525,49 +906,19 @@ async def chat(req: ChatRequest):
         await ChatHistoryService.update_session_files(req.session_id, req.file_ids)
 
     # 获取多个文件的数据（支持 file_id:sheet_name 格式）
-    files_data = []
-    for data_source_id in file_ids:
-        try:
-            # 解析 file_id:sheet_name 格式
-            if ":" in data_source_id:
-                actual_file_id, sheet_name = data_source_id.split(":", 1)
-            else:
-                actual_file_id = data_source_id
-                sheet_name = None
-
-            df = await get_dataframe(actual_file_id, sheet_name)
-            uploaded_file = await FileStorageService.get_file(actual_file_id)
-
-            # 构建显示名称（包含 sheet 名称）
-            filename = uploaded_file.filename if uploaded_file else actual_file_id
-            if sheet_name:
-                filename = f"{filename} [Sheet: {sheet_name}]"
-
-            files_data.append({
-                "file_id": data_source_id,
-                "filename": filename,
-                "columns": df.columns.tolist(),
-                "data": clean_dataframe_for_llm(df)
-            })
-        except Exception:
-            continue  # 跳过无法加载的文件
-
-    # 获取历史消息
-    history_messages = [
-        {"role": m.role.value, "content": m.content}
-        for m in session.messages
-    ]
+    files_data = await load_files_data(file_ids)
 
-    # 保存用户消息
+    # 保存用户消息（如果是第一条消息，同一事务中更新会话标题）
     await ChatHistoryService.add_message(
         session_id=req.session_id,
         role=MessageRole.USER,
-        content=req.message
+        content=req.message,
+        title=make_session_title(req.message) if is_first_message else None
     )
 
     try:
         # 调用 LLM（支持多文件）
-        result = chat_with_context_multi_files(
+        result = await chat_with_context_multi_files(
             files_data=files_data,
             user_prompt=req.message,
             history_messages=history_messages
@@ -580,12 +931,6 @@ async def chat(req: ChatRequest):
             content=result["content"],
             chart_config=result.get("chart_config")
         )
-
-        # 如果是第一条消息，更新会话标题
-        if len(session.messages) == 0:
-            title = req.message[:50] + ("..." if len(req.message) > 50 else "")
-            await ChatHistoryService.update_session_title(req.session_id, title)
-
         return ChatResponse(
             session_id=req.session_id,
             message=ChatMessageResponse(
@@ -599,15 +944,36 @@ async def chat(req: ChatRequest):
         raise HTTPException(status_code=500, detail=f"对话失败: {str(e)}")
 
 
+# 文本片段事件的固定前后缀，流式输出时只需编码片段本身
+SSE_CHUNK_PREFIX = b'data: {"type":"chunk","content":'
+SSE_CHUNK_SUFFIX = b'}\n\n'
+
+
+def sse_event(payload: dict) -> bytes:
+    """SSE 格式: data: {json}\n\n"""
+    return b"data: " + orjson.dumps(payload) + b"\n\n"
+
+
+def sse_chunk(content: str) -> bytes:
+    """文本片段事件，等价于 sse_event({'type': 'chunk', 'content': content})"""
+    return SSE_CHUNK_PREFIX + orjson.dumps(content) + SSE_CHUNK_SUFFIX
+
+
 @app.post("/api/chat/stream")
 @limiter.limit("20/minute")  # 每分钟最多 20 次对话请求
 async def chat_stream(request: Request, req: ChatRequest):
     """流式多轮对话接口 - 使用 SSE"""
-    # 获取会话
-    session = await ChatHistoryService.get_session(req.session_id)
+    # 获取会话（不加载消息）和历史消息
+    session, history_messages = await asyncio.gather(
+        ChatHistoryService.get_session_meta(req.session_id),
+        ChatHistoryService.get_history_messages(req.session_id),
+    )
     if not session:
         raise HTTPException(status_code=404, detail="会话不存在")
 
+    # 在写入任何消息之前判断是否为第一条消息
+    is_first_message = not history_messages
+
     # 确定要使用的文件ID列表
     file_ids = req.file_ids or session.file_ids or []
 
@@ -616,48 +982,20 @@ async def chat_stream(request: Request, req: ChatRequest):
         await ChatHistoryService.update_session_files(req.session_id, req.file_ids)
 
     # 获取多个文件的数据（支持 file_id:sheet_name 格式）
-    files_data = []
-    for data_source_id in file_ids:
-        try:
-            # 解析 file_id:sheet_name 格式
-            if ":" in data_source_id:
-                actual_file_id, sheet_name = data_source_id.split(":", 1)
-            else:
-                actual_file_id = data_source_id
-                sheet_name = None
-
-            df = await get_dataframe(actual_file_id, sheet_name)
-            uploaded_file = await FileStorageService.get_file(actual_file_id)
-
-            # 构建显示名称（包含 sheet 名称）
-            filename = uploaded_file.filename if uploaded_file else actual_file_id
-            if sheet_name:
-                filename = f"{filename} [Sheet: {sheet_name}]"
-
-            files_data.append({
-                "file_id": data_source_id,
-                "filename": filename,
-                "columns": df.columns.tolist(),
-                "data": clean_dataframe_for_llm(df)
-            })
-        except Exception:
-            continue
-
-    # 获取历史消息
-    history_messages = [
-        {"role": m.role.value, "content": m.content}
-        for m in session.messages
-    ]
+    files_data = await load_files_data(file_ids)
 
-    # 保存用户消息
+    # 保存用户消息（如果是第一条消息，同一事务中更新会话标题）
     await ChatHistoryService.add_message(
         session_id=req.session_id,
         role=MessageRole.USER,
-        content=req.message
+        content=req.message,
+        title=make_session_title(req.message) if is_first_message else None
     )
 
     async def generate():
         full_content = ""
+        # 图表配置随流式片段增量提取，不在结束后重新扫描完整回复
+        chart_extractor = StreamingChartExtractor()
         try:
             async for chunk in stream_chat_multi_files(
                 files_data=files_data,
@@ -665,11 +1003,10 @@ async def chat_stream(request: Request, req: ChatRequest):
                 history_messages=history_messages
             ):
                 full_content += chunk
-                # SSE 格式: data: {json}\n\n
-                yield f"data: {json.dumps({'type': 'chunk', 'content': chunk}, ensure_ascii=False)}\n\n"
+                chart_extractor.feed(chunk)
+                yield sse_chunk(chunk)
 
-            # 流式结束后，提取图表配置
-            chart_config = extract_chart_config(full_content)
+            chart_config = chart_extractor.result()
 
             # 保存助手回复
             await ChatHistoryService.add_message(
@@ -678,17 +1015,11 @@ async def chat_stream(request: Request, req: ChatRequest):
                 content=full_content,
                 chart_config=chart_config
             )
-
-            # 如果是第一条消息，更新会话标题
-            if len(session.messages) == 0:
-                title = req.message[:50] + ("..." if len(req.message) > 50 else "")
-                await ChatHistoryService.update_session_title(req.session_id, title)
-
             # 发送完成事件
-            yield f"data: {json.dumps({'type': 'done', 'chart_config': chart_config}, ensure_ascii=False)}\n\n"
+            yield sse_event({'type': 'done', 'chart_config': chart_config})
 
         except Exception as e:
-            yield f"data: {json.dumps({'type': 'error', 'message': str(e)}, ensure_ascii=False)}\n\n"
+            yield sse_event({'type': 'error', 'message': str(e)})
 
     return StreamingResponse(
         generate(),
@@ -708,13 +1039,20 @@ async def list_charts(request: Request, page: int = 1, limit: int = 9):
     """获取当前用户的所有保存的图表"""
     client_id = get_client_id(request)
     charts, total = await ChartService.get_all_charts(page=page, limit=limit, client_id=client_id)
-    return {
+    body = orjson.dumps({
         "items": charts,
         "total": total,
         "page": page,
         "limit": limit,
         "has_more": page * limit < total
-    }
+    })
+
+    # 图表列表会变化，ETag 由响应内容决定，未变化时返回 304 省去传输
+    etag = f'"{hashlib.blake2b(body, digest_size=8).hexdigest()}"'
+    cache_headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+    if etag_matches(request, etag):
+        return Response(status_code=304, headers=cache_headers)
+    return Response(content=body, media_type="application/json", headers=cache_headers)
 
 
 @app.delete("/api/charts/{message_id}")
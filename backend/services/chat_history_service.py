@@ -1,18 +1,123 @@
+import os
+import time
 import uuid
-import json
-import pickle
-from typing import Optional, List, Tuple
+import shutil
+from urllib.parse import quote
+import asyncio
+import orjson
+from typing import Optional, List, Tuple, Dict, Union, BinaryIO
+from datetime import datetime
+from dataclasses import dataclass, field
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select, desc, func
-from sqlalchemy.orm import selectinload
+from sqlalchemy import select, desc, func, update, delete, insert, not_, type_coerce, Text
+from sqlalchemy.orm import noload, undefer, load_only
 
-from .database import ChatSession, ChatMessage, MessageRole, UploadedFile, async_session_maker
-from .redis_service import redis_client
+from .database import ChatSession, ChatMessage, MessageRole, UploadedFile, async_session_maker, read_session_maker
+from .redis_service import redis_client, wait_for_cache_fill, release_fill_lock, dumps_cache_json, loads_cache_json
 
 # 缓存过期时间
 SESSIONS_CACHE_TTL = 60  # 会话列表缓存 60 秒
 SESSION_DETAIL_CACHE_TTL = 300  # 会话详情缓存 5 分钟
 
+# 会话列表缓存 key 的索引集合（全部 / 按 client_id），集合与缓存同时过期
+SESSIONS_INDEX_KEY = "sessions:list-index"
+
+# 上传文件的本地副本目录（解析时直接读取磁盘文件，避免在内存中复制文件内容）
+FILE_STORAGE_DIR = os.getenv("FILE_STORAGE_DIR", "uploads")
+# 上传文件写入本地副本时的分块大小
+UPLOAD_CHUNK_SIZE = 1 << 20
+# 本地副本的总大小上限和最长保留时间（秒），超出时按最近使用时间清理，需要时从数据库重新写入
+FILE_STORAGE_MAX_BYTES = int(os.getenv("FILE_STORAGE_MAX_BYTES", 2 * 1024 * 1024 * 1024))
+FILE_STORAGE_MAX_AGE = int(os.getenv("FILE_STORAGE_MAX_AGE", 7 * 24 * 3600))
+# 两次清理之间的最小间隔（秒）
+FILE_STORAGE_PRUNE_INTERVAL = int(os.getenv("FILE_STORAGE_PRUNE_INTERVAL", 300))
+# 最近写入的文件可能正在解析，清理时跳过
+FILE_STORAGE_MIN_AGE = 300
+
+# 每轮对话发送给 LLM 的历史消息条数上限
+HISTORY_MESSAGES_LIMIT = int(os.getenv("HISTORY_MESSAGES_LIMIT", 20))
+# 会话详情返回的消息条数上限（最近的消息）
+SESSION_DETAIL_MESSAGES_LIMIT = int(os.getenv("SESSION_DETAIL_MESSAGES_LIMIT", 200))
+
+# MySQL ngram 全文解析器的分词长度（ngram_token_size）
+TITLE_SEARCH_NGRAM_SIZE = int(os.getenv("TITLE_SEARCH_NGRAM_SIZE", 2))
+
+# 会话列表只查询列表项需要的列（不读取 file_metadata JSON）
+SESSION_LIST_COLUMNS = (
+    ChatSession.id,
+    ChatSession.title,
+    ChatSession.file_ids,
+    ChatSession.created_at,
+    ChatSession.updated_at,
+)
+
+
+@dataclass
+class MessageRecord:
+    """会话消息的缓存记录（不包含 SQLAlchemy 状态，可直接用 orjson 序列化）"""
+    id: int
+    role: MessageRole
+    content: str
+    chart_config: Optional[dict]
+    created_at: datetime
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "MessageRecord":
+        return cls(
+            id=data["id"],
+            role=MessageRole(data["role"]),
+            content=data["content"],
+            chart_config=data["chart_config"],
+            created_at=datetime.fromisoformat(data["created_at"]),
+        )
+
+
+@dataclass
+class SessionRecord:
+    """会话的缓存记录，会话列表中 messages 为空"""
+    id: str
+    title: Optional[str]
+    file_ids: Optional[List[str]]
+    file_metadata: Optional[List[dict]]
+    created_at: datetime
+    updated_at: datetime
+    messages: List[MessageRecord] = field(default_factory=list)
+
+    @classmethod
+    def from_row(cls, chat_session: ChatSession) -> "SessionRecord":
+        return cls(
+            id=chat_session.id,
+            title=chat_session.title,
+            file_ids=chat_session.file_ids,
+            file_metadata=chat_session.file_metadata,
+            created_at=chat_session.created_at,
+            updated_at=chat_session.updated_at,
+        )
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "SessionRecord":
+        return cls(
+            id=data["id"],
+            title=data["title"],
+            file_ids=data["file_ids"],
+            file_metadata=data["file_metadata"],
+            created_at=datetime.fromisoformat(data["created_at"]),
+            updated_at=datetime.fromisoformat(data["updated_at"]),
+            messages=[MessageRecord.from_dict(m) for m in data["messages"]],
+        )
+
+    @classmethod
+    def from_list_row(cls, row) -> "SessionRecord":
+        """会话列表的投影行（SESSION_LIST_COLUMNS），不包含 file_metadata"""
+        return cls(
+            id=row.id,
+            title=row.title,
+            file_ids=row.file_ids,
+            file_metadata=None,
+            created_at=row.created_at,
+            updated_at=row.updated_at,
+        )
+
 
 class ChatHistoryService:
     """对话历史服务"""
@@ -44,60 +149,100 @@ class ChatHistoryService:
 
     @staticmethod
     async def _invalidate_sessions_cache(client_id: Optional[str] = None):
-        """使会话列表缓存失效"""
+        """
+        使会话列表缓存失效：从索引集合中取出已缓存的 key 一次删除，不需要 SCAN 整个键空间
+        """
+        # 指定 client_id 时只删除该 client_id 的缓存，否则删除所有会话列表缓存
+        index_key = f"{SESSIONS_INDEX_KEY}:{client_id}" if client_id else SESSIONS_INDEX_KEY
         try:
-            if client_id:
-                # 只删除该 client_id 的缓存
-                async for key in redis_client.scan_iter(match=f"sessions:list:{client_id}:*"):
-                    await redis_client.delete(key)
-            else:
-                # 删除所有会话列表缓存
-                async for key in redis_client.scan_iter(match="sessions:list:*"):
-                    await redis_client.delete(key)
+            keys = await redis_client.smembers(index_key)
+            async with redis_client.pipeline(transaction=False) as pipe:
+                if keys:
+                    pipe.delete(*keys)
+                pipe.delete(index_key)
+                await pipe.execute()
         except Exception:
             pass
 
     @staticmethod
-    async def get_session(session_id: str) -> Optional[ChatSession]:
-        """获取会话信息（带 Redis 缓存）"""
+    async def _delete_session_details(session_ids: List[str]):
+        """删除会话详情缓存（一条 DELETE 命令）"""
+        if not session_ids:
+            return
+        try:
+            await redis_client.delete(*(f"session:detail:{sid}" for sid in session_ids))
+        except Exception:
+            pass
+
+    @staticmethod
+    async def get_session(session_id: str) -> Optional[SessionRecord]:
+        """获取会话信息及全部消息（带 Redis 缓存，缓存内容为 orjson 编码的记录，较大时 zstd 压缩）"""
         cache_key = f"session:detail:{session_id}"
 
         # 尝试从 Redis 获取缓存
         try:
             cached = await redis_client.get(cache_key)
             if cached:
-                return pickle.loads(cached)
+                return SessionRecord.from_dict(loads_cache_json(cached))
         except Exception:
             pass
 
-        # 从数据库查询
-        async with async_session_maker() as session:
+        # 未命中时只让一个请求查询数据库，其他请求等待缓存写入
+        cached, lock_token = await wait_for_cache_fill(cache_key)
+        if cached:
+            return SessionRecord.from_dict(loads_cache_json(cached))
+
+        try:
+            record = await ChatHistoryService._load_session(session_id)
+            # 写入 Redis 缓存
+            if record:
+                try:
+                    await redis_client.setex(cache_key, SESSION_DETAIL_CACHE_TTL, dumps_cache_json(record))
+                except Exception:
+                    pass
+        finally:
+            await release_fill_lock(cache_key, lock_token)
+
+        return record
+
+    @staticmethod
+    async def _load_session(session_id: str) -> Optional[SessionRecord]:
+        """从数据库查询会话行（不加载关系）+ 最近 SESSION_DETAIL_MESSAGES_LIMIT 条消息"""
+        async with read_session_maker() as session:
             result = await session.execute(
                 select(ChatSession)
-                .options(selectinload(ChatSession.messages))
+                .options(noload(ChatSession.messages))
                 .where(ChatSession.id == session_id)
             )
             chat_session = result.scalar_one_or_none()
+            if not chat_session:
+                return None
+            record = SessionRecord.from_row(chat_session)
 
-            # 写入 Redis 缓存
-            if chat_session:
-                try:
-                    await redis_client.setex(
-                        cache_key,
-                        SESSION_DETAIL_CACHE_TTL,
-                        pickle.dumps(chat_session)
-                    )
-                except Exception:
-                    pass
+            result = await session.execute(
+                select(
+                    ChatMessage.id,
+                    ChatMessage.role,
+                    ChatMessage.content,
+                    ChatMessage.chart_config,
+                    ChatMessage.created_at,
+                )
+                .where(ChatMessage.session_id == session_id)
+                .order_by(ChatMessage.created_at.desc(), ChatMessage.id.desc())
+                .limit(SESSION_DETAIL_MESSAGES_LIMIT)
+            )
+            record.messages = [MessageRecord(*row) for row in reversed(result.all())]
 
-            return chat_session
+        return record
 
     @staticmethod
     async def get_all_sessions() -> List[ChatSession]:
-        """获取所有会话列表"""
-        async with async_session_maker() as session:
+        """获取所有会话列表（只加载列表需要的列）"""
+        async with read_session_maker() as session:
             result = await session.execute(
-                select(ChatSession).order_by(desc(ChatSession.updated_at))
+                select(ChatSession)
+                .options(load_only(*SESSION_LIST_COLUMNS))
+                .order_by(desc(ChatSession.updated_at))
             )
             return result.scalars().all()
 
@@ -107,7 +252,7 @@ class ChatHistoryService:
         limit: int = 9,
         search: Optional[str] = None,
         client_id: Optional[str] = None
-    ) -> Tuple[List[ChatSession], int]:
+    ) -> Tuple[List[SessionRecord], int]:
         """分页获取会话列表，支持搜索和 client_id 过滤（带 Redis 缓存）"""
         # 构建缓存 key（包含 client_id）
         cache_key = f"sessions:list:{client_id or 'all'}:{page}:{limit}:{search or ''}"
@@ -116,68 +261,107 @@ class ChatHistoryService:
         try:
             cached = await redis_client.get(cache_key)
             if cached:
-                data = pickle.loads(cached)
-                return data["sessions"], data["total"]
+                data = loads_cache_json(cached)
+                return [SessionRecord.from_dict(s) for s in data["sessions"]], data["total"]
         except Exception:
             pass
 
-        # 从数据库查询
-        async with async_session_maker() as session:
-            # 基础查询
-            query = select(ChatSession)
-            count_query = select(func.count(ChatSession.id))
+        # 未命中时只让一个请求查询数据库，其他请求等待缓存写入
+        cached, lock_token = await wait_for_cache_fill(cache_key)
+        if cached:
+            data = loads_cache_json(cached)
+            return [SessionRecord.from_dict(s) for s in data["sessions"]], data["total"]
 
-            # client_id 过滤
-            if client_id:
-                query = query.where(ChatSession.client_id == client_id)
-                count_query = count_query.where(ChatSession.client_id == client_id)
+        try:
+            sessions, total = await ChatHistoryService._query_sessions_page(page, limit, search, client_id)
 
-            # 搜索过滤
-            if search:
-                search_pattern = f"%{search}%"
-                query = query.where(ChatSession.title.ilike(search_pattern))
-                count_query = count_query.where(ChatSession.title.ilike(search_pattern))
+            # 写入 Redis 缓存，并把 key 记录到索引集合（用于失效时定位）
+            index_keys = [SESSIONS_INDEX_KEY, f"{SESSIONS_INDEX_KEY}:{client_id or 'all'}"]
+            try:
+                async with redis_client.pipeline(transaction=False) as pipe:
+                    pipe.setex(
+                        cache_key,
+                        SESSIONS_CACHE_TTL,
+                        dumps_cache_json({"sessions": sessions, "total": total})
+                    )
+                    for index_key in index_keys:
+                        pipe.sadd(index_key, cache_key)
+                        pipe.expire(index_key, SESSIONS_CACHE_TTL)
+                    await pipe.execute()
+            except Exception:
+                pass
+        finally:
+            await release_fill_lock(cache_key, lock_token)
 
-            # 获取总数
-            total_result = await session.execute(count_query)
-            total = total_result.scalar() or 0
+        return sessions, total
 
-            # 分页查询
-            offset = (page - 1) * limit
-            query = query.order_by(desc(ChatSession.updated_at)).offset(offset).limit(limit)
+    @staticmethod
+    async def _query_sessions_page(
+        page: int,
+        limit: int,
+        search: Optional[str],
+        client_id: Optional[str]
+    ) -> Tuple[List[SessionRecord], int]:
+        """从数据库分页查询会话列表"""
+        async with read_session_maker() as session:
+            # 过滤条件
+            filters = []
+            if client_id:
+                filters.append(ChatSession.client_id == client_id)
+            if search:
+                filters.append(ChatHistoryService._title_search_filter(search))
 
+            # 分页查询，总数通过窗口函数 COUNT(*) OVER() 在同一条语句中返回
+            offset = (page - 1) * limit
+            query = (
+                select(*SESSION_LIST_COLUMNS, func.count().over().label("total"))
+                .where(*filters)
+                .order_by(desc(ChatSession.updated_at))
+                .offset(offset)
+                .limit(limit)
+            )
             result = await session.execute(query)
-            sessions = list(result.scalars().all())
-
-            # 写入 Redis 缓存
-            try:
-                await redis_client.setex(
-                    cache_key,
-                    SESSIONS_CACHE_TTL,
-                    pickle.dumps({"sessions": sessions, "total": total})
+            rows = result.all()
+            sessions = [SessionRecord.from_list_row(row) for row in rows]
+
+            if rows:
+                total = rows[0].total
+            elif page > 1:
+                # 页码超出范围时没有返回行，单独查询总数
+                total_result = await session.execute(
+                    select(func.count(ChatSession.id)).where(*filters)
                 )
-            except Exception:
-                pass
+                total = total_result.scalar() or 0
+            else:
+                total = 0
 
             return sessions, total
 
+    @staticmethod
+    def _title_search_filter(search: str):
+        """
+        会话标题搜索条件：使用 FULLTEXT（ngram）索引做短语匹配；
+        短于 ngram 分词长度的搜索词无法命中全文索引，回退到 LIKE
+        """
+        term = search.replace('"', " ").strip()
+        if len(term) < TITLE_SEARCH_NGRAM_SIZE:
+            return ChatSession.title.ilike(f"%{search}%")
+        return ChatSession.title.match(f'"{term}"')
+
     @staticmethod
     async def get_session_with_message_count(session_id: str) -> Optional[dict]:
-        """获取会话信息及消息数量"""
-        async with async_session_maker() as session:
-            # 获取会话
+        """获取会话信息及消息数量（一条 LEFT JOIN + GROUP BY 查询）"""
+        async with read_session_maker() as session:
             result = await session.execute(
-                select(ChatSession).where(ChatSession.id == session_id)
+                select(ChatSession, func.count(ChatMessage.id))
+                .outerjoin(ChatMessage, ChatMessage.session_id == ChatSession.id)
+                .where(ChatSession.id == session_id)
+                .group_by(ChatSession.id)
             )
-            chat_session = result.scalar_one_or_none()
-            if not chat_session:
+            row = result.one_or_none()
+            if not row:
                 return None
-
-            # 获取消息数量
-            count_result = await session.execute(
-                select(func.count(ChatMessage.id)).where(ChatMessage.session_id == session_id)
-            )
-            message_count = count_result.scalar() or 0
+            chat_session, message_count = row
 
             return {
                 "session": chat_session,
@@ -186,23 +370,18 @@ class ChatHistoryService:
 
     @staticmethod
     async def delete_session(session_id: str, client_id: Optional[str] = None) -> bool:
-        """删除会话"""
+        """删除会话（消息由外键级联删除）"""
         async with async_session_maker() as session:
             result = await session.execute(
-                select(ChatSession).where(ChatSession.id == session_id)
+                delete(ChatSession).where(ChatSession.id == session_id)
             )
-            chat_session = result.scalar_one_or_none()
-            if chat_session:
-                await session.delete(chat_session)
-                await session.commit()
-
-                # 使缓存失效
-                try:
-                    await redis_client.delete(f"session:detail:{session_id}")
-                    await ChatHistoryService._invalidate_sessions_cache(client_id)
-                except Exception:
-                    pass
-
+            await session.commit()
+            if result.rowcount > 0:
+                # 使缓存失效（提交之后执行，两个 Redis 操作互不依赖，并发执行）
+                await asyncio.gather(
+                    ChatHistoryService._delete_session_details([session_id]),
+                    ChatHistoryService._invalidate_sessions_cache(client_id),
+                )
                 return True
             return False
 
@@ -221,20 +400,17 @@ class ChatHistoryService:
             # 删除会话（级联删除消息）
             deleted_count = len(session_ids)
             if deleted_count > 0:
-                from sqlalchemy import delete
                 delete_query = delete(ChatSession)
                 if client_id:
                     delete_query = delete_query.where(ChatSession.client_id == client_id)
                 await session.execute(delete_query)
                 await session.commit()
 
-                # 清除相关缓存
-                try:
-                    for sid in session_ids:
-                        await redis_client.delete(f"session:detail:{sid}")
-                    await ChatHistoryService._invalidate_sessions_cache(client_id)
-                except Exception:
-                    pass
+                # 清除相关缓存：会话详情一条 DELETE 批量删除，与会话列表缓存失效并发执行
+                await asyncio.gather(
+                    ChatHistoryService._delete_session_details(session_ids),
+                    ChatHistoryService._invalidate_sessions_cache(client_id),
+                )
 
             return deleted_count
 
@@ -244,20 +420,29 @@ class ChatHistoryService:
         role: MessageRole,
         content: str,
         chart_config: Optional[dict] = None,
-        thinking: Optional[str] = None
+        thinking: Optional[str] = None,
+        title: Optional[str] = None
     ) -> ChatMessage:
-        """添加消息到会话"""
+        """
+        添加消息到会话，指定 title 时在同一事务中更新会话标题（用于会话的第一条消息）。
+        直接执行 INSERT 并使用自增主键构造返回对象，无需 refresh 再查询一次
+        """
+        values = {
+            "session_id": session_id,
+            "role": role,
+            "content": content,
+            "chart_config": chart_config or None,
+            "thinking": thinking,
+            "created_at": datetime.utcnow(),
+        }
         async with async_session_maker() as session:
-            message = ChatMessage(
-                session_id=session_id,
-                role=role,
-                content=content,
-                chart_config=json.dumps(chart_config) if chart_config else None,
-                thinking=thinking
-            )
-            session.add(message)
-            await session.commit()
-            await session.refresh(message)
+            async with session.begin():
+                result = await session.execute(insert(ChatMessage).values(**values))
+                if title is not None:
+                    await session.execute(
+                        update(ChatSession).where(ChatSession.id == session_id).values(title=title)
+                    )
+            message = ChatMessage(id=result.inserted_primary_key[0], **values)
 
             # 使会话详情缓存失效
             try:
@@ -270,7 +455,7 @@ class ChatHistoryService:
     @staticmethod
     async def get_session_messages(session_id: str, limit: int = 20) -> List[ChatMessage]:
         """获取会话的历史消息"""
-        async with async_session_maker() as session:
+        async with read_session_maker() as session:
             result = await session.execute(
                 select(ChatMessage)
                 .where(ChatMessage.session_id == session_id)
@@ -279,62 +464,83 @@ class ChatHistoryService:
             )
             return result.scalars().all()
 
+    @staticmethod
+    async def get_session_meta(session_id: str) -> Optional[ChatSession]:
+        """获取会话行（不加载消息，用于对话接口）"""
+        async with read_session_maker() as session:
+            result = await session.execute(
+                select(ChatSession)
+                .options(noload(ChatSession.messages))
+                .where(ChatSession.id == session_id)
+            )
+            return result.scalar_one_or_none()
+
+    @staticmethod
+    async def get_history_messages(session_id: str, limit: int = HISTORY_MESSAGES_LIMIT) -> List[dict]:
+        """
+        获取发送给 LLM 的最近 limit 条历史消息（按时间正序）。
+        只查询 role 和 content 列，不构造 ORM 对象
+        """
+        async with read_session_maker() as session:
+            result = await session.execute(
+                select(ChatMessage.role, ChatMessage.content)
+                .where(ChatMessage.session_id == session_id)
+                .order_by(ChatMessage.created_at.desc(), ChatMessage.id.desc())
+                .limit(limit)
+            )
+            rows = result.all()
+            return [{"role": role.value, "content": content} for role, content in reversed(rows)]
+
     @staticmethod
     async def update_session_title(session_id: str, title: str) -> bool:
         """更新会话标题"""
         async with async_session_maker() as session:
             result = await session.execute(
-                select(ChatSession).where(ChatSession.id == session_id)
+                update(ChatSession).where(ChatSession.id == session_id).values(title=title)
             )
-            chat_session = result.scalar_one_or_none()
-            if chat_session:
-                chat_session.title = title
-                await session.commit()
-                return True
-            return False
+            await session.commit()
+            return result.rowcount > 0
 
     @staticmethod
     async def update_session_files(session_id: str, file_ids: List[str]) -> bool:
         """更新会话关联的文件列表"""
         async with async_session_maker() as session:
             result = await session.execute(
-                select(ChatSession).where(ChatSession.id == session_id)
+                update(ChatSession).where(ChatSession.id == session_id).values(file_ids=file_ids)
             )
-            chat_session = result.scalar_one_or_none()
-            if chat_session:
-                chat_session.file_ids = file_ids
-                await session.commit()
-                return True
-            return False
+            await session.commit()
+            return result.rowcount > 0
 
     @staticmethod
     async def add_session_file(session_id: str, file_id: str) -> bool:
-        """向会话添加一个文件"""
+        """向会话添加一个文件（JSON_ARRAY_APPEND 原子追加，避免先读后写的并发覆盖）"""
         async with async_session_maker() as session:
+            current_files = func.coalesce(ChatSession.file_ids, func.json_array())
             result = await session.execute(
-                select(ChatSession).where(ChatSession.id == session_id)
+                update(ChatSession)
+                .where(ChatSession.id == session_id)
+                .where(not_(func.json_contains(current_files, func.json_quote(file_id))))
+                .values(file_ids=func.json_array_append(current_files, "$", file_id))
             )
-            chat_session = result.scalar_one_or_none()
-            if chat_session:
-                current_files = chat_session.file_ids or []
-                if file_id not in current_files:
-                    current_files.append(file_id)
-                    chat_session.file_ids = current_files
-                    await session.commit()
+            await session.commit()
+            if result.rowcount > 0:
                 return True
-            return False
+
+            # 没有更新时区分"文件已存在"和"会话不存在"
+            result = await session.execute(
+                select(ChatSession.id).where(ChatSession.id == session_id)
+            )
+            return result.scalar_one_or_none() is not None
 
     @staticmethod
     async def update_session_file_metadata(session_id: str, file_metadata: List[dict]) -> bool:
         """更新会话的文件元信息"""
         async with async_session_maker() as session:
             result = await session.execute(
-                select(ChatSession).where(ChatSession.id == session_id)
+                update(ChatSession).where(ChatSession.id == session_id).values(file_metadata=file_metadata)
             )
-            chat_session = result.scalar_one_or_none()
-            if chat_session:
-                chat_session.file_metadata = file_metadata
-                await session.commit()
+            await session.commit()
+            if result.rowcount > 0:
                 # 使缓存失效
                 try:
                     await redis_client.delete(f"session:detail:{session_id}")
@@ -347,6 +553,8 @@ class ChatHistoryService:
 class FileStorageService:
     """文件存储服务 - 使用 MySQL 存储"""
 
+    _last_prune = 0.0
+
     @staticmethod
     async def save_file(
         file_id: str,
@@ -354,9 +562,15 @@ class FileStorageService:
         data: bytes,
         columns: List[str],
         rows: int,
-        file_type: str
+        file_type: str,
+        sheet_names: Optional[List[str]] = None,
+        data_parquet: Optional[bytes] = None,
+        preview_json: Optional[str] = None
     ) -> UploadedFile:
-        """保存文件到数据库"""
+        """
+        保存文件到数据库，本地副本由 store_upload 写入。
+        data_parquet / preview_json 为默认 sheet 的解析结果和数据预览，缓存未命中时无需重新解析
+        """
         async with async_session_maker() as session:
             uploaded_file = UploadedFile(
                 id=file_id,
@@ -364,44 +578,180 @@ class FileStorageService:
                 data=data,
                 columns=columns,
                 rows=rows,
-                file_type=file_type
+                file_type=file_type,
+                sheet_names=sheet_names,
+                data_parquet=data_parquet,
+                preview_json=preview_json
             )
             session.add(uploaded_file)
             await session.commit()
             await session.refresh(uploaded_file)
-            return uploaded_file
+        return uploaded_file
 
     @staticmethod
-    async def get_file(file_id: str) -> Optional[UploadedFile]:
-        """获取文件信息"""
-        async with async_session_maker() as session:
+    async def store_upload(file_id: str, fileobj: BinaryIO) -> str:
+        """将上传的文件流分块写入本地副本（不在内存中整体读取），返回本地路径"""
+        await asyncio.to_thread(FileStorageService._write_local_copy, file_id, fileobj)
+        return FileStorageService._local_path(file_id)
+
+    @staticmethod
+    def remove_local_copy(file_id: str):
+        """删除本地副本及其 Parquet 缓存目录"""
+        try:
+            os.remove(FileStorageService._local_path(file_id))
+        except FileNotFoundError:
+            pass
+        shutil.rmtree(os.path.join(FILE_STORAGE_DIR, file_id), ignore_errors=True)
+
+    @staticmethod
+    async def prune_local_storage():
+        """按间隔触发本地副本清理（在线程中执行，不阻塞事件循环）"""
+        now = time.monotonic()
+        if now - FileStorageService._last_prune < FILE_STORAGE_PRUNE_INTERVAL:
+            return
+        FileStorageService._last_prune = now
+        await asyncio.to_thread(FileStorageService._prune_local_files)
+
+    @staticmethod
+    def _prune_local_files():
+        """
+        清理本地副本和 Parquet 缓存：删除超过保留时间的文件，总大小超过上限时从最久未使用的开始删除。
+        以修改时间作为最近使用时间（读取时会更新），删除后可从数据库重新写入或重新解析
+        """
+        entries = []
+        cache_dirs = []
+
+        def collect(directory: str):
+            with os.scandir(directory) as it:
+                for entry in it:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            if directory == FILE_STORAGE_DIR:
+                                cache_dirs.append(entry.path)
+                            continue
+                        stat = entry.stat(follow_symlinks=False)
+                    except FileNotFoundError:
+                        continue
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+        try:
+            collect(FILE_STORAGE_DIR)
+        except FileNotFoundError:
+            return
+        for cache_dir in cache_dirs:
+            try:
+                collect(cache_dir)
+            except (FileNotFoundError, NotADirectoryError):
+                pass
+
+        now = time.time()
+        total = 0
+        for mtime, size, path in sorted(entries, reverse=True):
+            age = now - mtime
+            if age < FILE_STORAGE_MIN_AGE:
+                total += size
+                continue
+            if age > FILE_STORAGE_MAX_AGE or total + size > FILE_STORAGE_MAX_BYTES:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            else:
+                total += size
+
+        # 删除已清空的 Parquet 缓存目录（非空时 rmdir 失败，直接跳过）
+        for cache_dir in cache_dirs:
+            try:
+                os.rmdir(cache_dir)
+            except OSError:
+                pass
+
+    @staticmethod
+    def _local_path(file_id: str) -> str:
+        return os.path.join(FILE_STORAGE_DIR, f"{file_id}.bin")
+
+    @staticmethod
+    def _write_local_copy(file_id: str, data: Union[bytes, BinaryIO]):
+        """写入本地副本（bytes 或文件流，先写临时文件再重命名，避免读到不完整的文件）"""
+        os.makedirs(FILE_STORAGE_DIR, exist_ok=True)
+        path = FileStorageService._local_path(file_id)
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp_path, "wb") as f:
+            if isinstance(data, bytes):
+                f.write(data)
+            else:
+                shutil.copyfileobj(data, f, UPLOAD_CHUNK_SIZE)
+        os.replace(tmp_path, path)
+
+    @staticmethod
+    def get_parquet_path(file_id: str, sheet_name: Optional[str] = None) -> str:
+        """单个 sheet 解析结果的 Parquet 缓存路径"""
+        name = quote(sheet_name, safe="") if sheet_name else "_default"
+        return os.path.join(FILE_STORAGE_DIR, file_id, f"{name}.parquet")
+
+    @staticmethod
+    async def get_file_path(uploaded_file: UploadedFile) -> str:
+        """获取文件的本地副本路径，不存在时（如其他实例上传）从数据库内容写入"""
+        path = FileStorageService._local_path(uploaded_file.id)
+        try:
+            # 更新修改时间，清理时按最近使用保留
+            os.utime(path)
+        except FileNotFoundError:
+            data = await FileStorageService.get_file_data(uploaded_file.id)
+            await asyncio.to_thread(FileStorageService._write_local_copy, uploaded_file.id, data)
+        return path
+
+    @staticmethod
+    async def get_file(file_id: str, with_parquet: bool = False) -> Optional[UploadedFile]:
+        """获取文件信息（不加载文件内容，with_parquet 时同时加载 Parquet 数据）"""
+        query = select(UploadedFile).where(UploadedFile.id == file_id)
+        if with_parquet:
+            query = query.options(undefer(UploadedFile.data_parquet))
+        async with read_session_maker() as session:
+            result = await session.execute(query)
+            return result.scalar_one_or_none()
+
+    @staticmethod
+    async def get_file_data(file_id: str) -> Optional[bytes]:
+        """获取文件的原始二进制内容"""
+        async with read_session_maker() as session:
             result = await session.execute(
-                select(UploadedFile).where(UploadedFile.id == file_id)
+                select(UploadedFile.data).where(UploadedFile.id == file_id)
             )
             return result.scalar_one_or_none()
 
     @staticmethod
     async def get_files(file_ids: List[str]) -> List[UploadedFile]:
-        """批量获取多个文件"""
+        """批量获取多个文件（不加载文件内容）"""
         if not file_ids:
             return []
-        async with async_session_maker() as session:
+        async with read_session_maker() as session:
             result = await session.execute(
                 select(UploadedFile).where(UploadedFile.id.in_(file_ids))
             )
             return result.scalars().all()
 
+    @staticmethod
+    async def get_filenames(file_ids: List[str]) -> Dict[str, str]:
+        """批量获取文件名（只查询 id 和 filename 列，不加载文件内容）"""
+        if not file_ids:
+            return {}
+        async with read_session_maker() as session:
+            result = await session.execute(
+                select(UploadedFile.id, UploadedFile.filename).where(UploadedFile.id.in_(file_ids))
+            )
+            return {file_id: filename for file_id, filename in result.all()}
+
     @staticmethod
     async def delete_file(file_id: str) -> bool:
         """删除文件"""
         async with async_session_maker() as session:
             result = await session.execute(
-                select(UploadedFile).where(UploadedFile.id == file_id)
+                delete(UploadedFile).where(UploadedFile.id == file_id)
             )
-            uploaded_file = result.scalar_one_or_none()
-            if uploaded_file:
-                await session.delete(uploaded_file)
-                await session.commit()
+            await session.commit()
+            if result.rowcount > 0:
+                FileStorageService.remove_local_copy(file_id)
                 return True
             return False
 
@@ -415,78 +765,83 @@ class ChartService:
         limit: int = 9,
         client_id: Optional[str] = None
     ) -> Tuple[List[dict], int]:
-        """获取所有保存的图表（从消息中提取有 chart_config 的记录，按 client_id 过滤）"""
-        async with async_session_maker() as session:
+        """
+        获取所有保存的图表（从消息中提取有 chart_config 的记录，按 client_id 过滤）。
+        chart_config 以原始 JSON 文本返回（orjson.Fragment），序列化响应时原样嵌入，不解析再编码
+        """
+        async with read_session_maker() as session:
             # 查询有图表配置的消息，通过 JOIN session 来过滤 client_id
-            query = (
-                select(ChatMessage, ChatSession.title)
-                .join(ChatSession, ChatMessage.session_id == ChatSession.id)
-                .where(ChatMessage.chart_config.isnot(None))
-                .where(ChatMessage.role == MessageRole.ASSISTANT)
-            )
-
-            # 按 client_id 过滤
+            # 只查询需要的列，不构造完整的 ChatMessage 对象（content、thinking 可能很大）
+            filters = [
+                ChatMessage.chart_config.isnot(None),
+                ChatMessage.role == MessageRole.ASSISTANT,
+            ]
             if client_id:
-                query = query.where(ChatSession.client_id == client_id)
-
-            query = query.order_by(desc(ChatMessage.created_at))
+                filters.append(ChatSession.client_id == client_id)
 
-            # 获取总数
-            count_query = (
-                select(func.count(ChatMessage.id))
+            # 分页查询，总数通过窗口函数 COUNT(*) OVER() 在同一条语句中返回
+            offset = (page - 1) * limit
+            query = (
+                select(
+                    ChatMessage.id,
+                    ChatMessage.session_id,
+                    type_coerce(ChatMessage.chart_config, Text).label("chart_config"),
+                    ChatMessage.created_at,
+                    ChatSession.title,
+                    func.count().over().label("total"),
+                )
                 .join(ChatSession, ChatMessage.session_id == ChatSession.id)
-                .where(ChatMessage.chart_config.isnot(None))
-                .where(ChatMessage.role == MessageRole.ASSISTANT)
+                .where(*filters)
+                .order_by(desc(ChatMessage.created_at))
+                .offset(offset)
+                .limit(limit)
             )
-            if client_id:
-                count_query = count_query.where(ChatSession.client_id == client_id)
-
-            total_result = await session.execute(count_query)
-            total = total_result.scalar() or 0
-
-            # 分页
-            offset = (page - 1) * limit
-            query = query.offset(offset).limit(limit)
-
             result = await session.execute(query)
             rows = result.all()
 
-            charts = []
-            for msg, session_title in rows:
-                chart_config = None
-                if msg.chart_config:
-                    try:
-                        chart_config = json.loads(msg.chart_config)
-                    except json.JSONDecodeError:
-                        continue
+            if rows:
+                total = rows[0].total
+            elif page > 1:
+                # 页码超出范围时没有返回行，单独查询总数
+                total_result = await session.execute(
+                    select(func.count(ChatMessage.id))
+                    .join(ChatSession, ChatMessage.session_id == ChatSession.id)
+                    .where(*filters)
+                )
+                total = total_result.scalar() or 0
+            else:
+                total = 0
 
-                charts.append({
-                    "id": msg.id,
-                    "session_id": msg.session_id,
-                    "session_title": session_title or "未命名对话",
-                    "chart_config": chart_config,
-                    "created_at": msg.created_at.isoformat() if msg.created_at else None
-                })
+        # 在释放数据库连接之后再构造结果
+        charts = []
+        for message_id, session_id, chart_config, created_at, session_title, _ in rows:
+            charts.append({
+                "id": message_id,
+                "session_id": session_id,
+                "session_title": session_title or "未命名对话",
+                "chart_config": orjson.Fragment(chart_config),
+                "created_at": created_at.isoformat() if created_at else None
+            })
 
-            return charts, total
+        return charts, total
 
     @staticmethod
     async def delete_chart(message_id: int, client_id: Optional[str] = None) -> bool:
         """删除图表（清除消息的 chart_config，验证 client_id 权限）"""
         async with async_session_maker() as session:
-            # 通过 JOIN 验证 client_id 权限
             query = (
-                select(ChatMessage)
-                .join(ChatSession, ChatMessage.session_id == ChatSession.id)
+                update(ChatMessage)
                 .where(ChatMessage.id == message_id)
+                .values(chart_config=None)
             )
             if client_id:
-                query = query.where(ChatSession.client_id == client_id)
+                # 通过子查询验证 client_id 权限
+                query = query.where(
+                    ChatMessage.session_id.in_(
+                        select(ChatSession.id).where(ChatSession.client_id == client_id)
+                    )
+                )
 
             result = await session.execute(query)
-            message = result.scalar_one_or_none()
-            if message:
-                message.chart_config = None
-                await session.commit()
-                return True
-            return False
+            await session.commit()
+            return result.rowcount > 0
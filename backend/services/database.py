@@ -2,10 +2,11 @@ import os
 from dotenv import load_dotenv
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession, async_sessionmaker
 from sqlalchemy.orm import DeclarativeBase
-from sqlalchemy import Column, String, Text, DateTime, Integer, ForeignKey, Enum as SQLEnum, JSON, LargeBinary, text
-from sqlalchemy.orm import relationship
+from sqlalchemy import Column, String, Text, DateTime, Integer, ForeignKey, Enum as SQLEnum, JSON, LargeBinary, Index, text
+from sqlalchemy.orm import relationship, deferred
 from datetime import datetime
 import enum
+import orjson
 
 load_dotenv()
 
@@ -23,11 +24,18 @@ engine = create_async_engine(
     max_overflow=30,  # 峰值额外连接（总共最多 50 连接）
     pool_recycle=3600,  # 1小时回收连接，防止 MySQL 超时断开
     pool_timeout=30,  # 获取连接超时时间
+    # JSON 列使用 orjson 编解码
+    json_serializer=lambda obj: orjson.dumps(obj).decode(),
+    json_deserializer=orjson.loads,
 )
 
 # 创建异步会话工厂
 async_session_maker = async_sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
 
+# 只读查询使用 AUTOCOMMIT 连接（共享同一个连接池），单条 SELECT 不需要 BEGIN/COMMIT
+read_engine = engine.execution_options(isolation_level="AUTOCOMMIT")
+read_session_maker = async_sessionmaker(read_engine, class_=AsyncSession, expire_on_commit=False)
+
 
 class Base(DeclarativeBase):
     pass
@@ -47,8 +55,12 @@ class UploadedFile(Base):
     filename = Column(String(255), nullable=False, comment="原始文件名")
     columns = Column(JSON, nullable=True, comment="列名数组")
     rows = Column(Integer, nullable=True, comment="数据行数")
-    data = Column(LargeBinary(length=16777215), nullable=True, comment="文件二进制数据(MEDIUMBLOB)")
+    # 二进制列延迟加载，只查询元信息时不读取文件内容（需要时用 undefer 或单独查询）
+    data = deferred(Column(LargeBinary(length=16777215), nullable=True, comment="文件二进制数据(MEDIUMBLOB)"))
     file_type = Column(String(10), nullable=True, comment="文件类型: xlsx/xls/csv")
+    sheet_names = Column(JSON, nullable=True, comment="Excel sheet 名称数组")
+    data_parquet = deferred(Column(LargeBinary(length=16777215), nullable=True, comment="默认 sheet 解析结果的 Parquet 数据(MEDIUMBLOB)"))
+    preview_json = Column(Text(length=16777215), nullable=True, comment="默认 sheet 数据预览 JSON(MEDIUMTEXT)")
     created_at = Column(DateTime, default=datetime.utcnow, comment="创建时间")
 
 
@@ -67,6 +79,14 @@ class ChatSession(Base):
     # 关联消息
     messages = relationship("ChatMessage", back_populates="session", cascade="all, delete-orphan", order_by="ChatMessage.created_at")
 
+    __table_args__ = (
+        # 会话列表按更新时间倒序分页（全部 / 按 client_id）
+        Index("ix_sessions_updated_at", "updated_at"),
+        Index("ix_sessions_client_updated", "client_id", "updated_at"),
+        # 会话标题搜索（ngram 分词，支持中文）
+        Index("ft_sessions_title", "title", mysql_prefix="FULLTEXT", mysql_with_parser="ngram"),
+    )
+
 
 class ChatMessage(Base):
     """对话消息表"""
@@ -76,13 +96,20 @@ class ChatMessage(Base):
     session_id = Column(String(36), ForeignKey("chat_sessions.id", ondelete="CASCADE"), nullable=False, index=True)
     role = Column(SQLEnum(MessageRole), nullable=False, comment="消息角色: user/assistant/system")
     content = Column(Text, nullable=False, comment="消息内容")
-    chart_config = Column(Text, nullable=True, comment="图表配置JSON")
+    chart_config = Column(JSON(none_as_null=True), nullable=True, comment="图表配置JSON")
     thinking = Column(Text, nullable=True, comment="思考过程")
     created_at = Column(DateTime, default=datetime.utcnow, comment="创建时间")
 
     # 关联会话
     session = relationship("ChatSession", back_populates="messages")
 
+    __table_args__ = (
+        # 会话内消息按时间排序
+        Index("ix_messages_session_created", "session_id", "created_at"),
+        # 图表列表：助手消息按时间倒序分页
+        Index("ix_messages_role_created", "role", "created_at"),
+    )
+
 
 async def init_db():
     """初始化数据库，创建所有表"""
@@ -93,6 +120,20 @@ async def init_db():
     await run_migrations()
 
 
+# 需要补建的索引：(表名, 索引名, 列)，与模型中的 __table_args__ 保持一致
+MIGRATION_INDEXES = [
+    ("chat_sessions", "ix_sessions_updated_at", "updated_at"),
+    ("chat_sessions", "ix_sessions_client_updated", "client_id, updated_at"),
+    ("chat_messages", "ix_messages_session_created", "session_id, created_at"),
+    ("chat_messages", "ix_messages_role_created", "role, created_at"),
+]
+
+# 需要补建的全文索引：(表名, 索引名, 列)
+MIGRATION_FULLTEXT_INDEXES = [
+    ("chat_sessions", "ft_sessions_title", "title"),
+]
+
+
 async def run_migrations():
     """执行数据库迁移 - 添加缺失的列"""
     async with async_session_maker() as session:
@@ -140,6 +181,134 @@ async def run_migrations():
             print(f"Migration error (client_id): {e}")
             await session.rollback()
 
+        # 检查 uploaded_files.sheet_names 列是否存在
+        try:
+            result = await session.execute(
+                text("SELECT COLUMN_NAME FROM INFORMATION_SCHEMA.COLUMNS WHERE TABLE_NAME = 'uploaded_files' AND COLUMN_NAME = 'sheet_names'")
+            )
+            exists = result.scalar()
+
+            if not exists:
+                await session.execute(
+                    text("ALTER TABLE uploaded_files ADD COLUMN sheet_names JSON NULL COMMENT 'Excel sheet 名称数组'")
+                )
+                await session.commit()
+                print("Migration: Added 'sheet_names' column to uploaded_files table")
+            else:
+                print("Migration: 'sheet_names' column already exists")
+        except Exception as e:
+            print(f"Migration error (sheet_names): {e}")
+            await session.rollback()
+
+        # 检查 uploaded_files.data_parquet 列是否存在
+        try:
+            result = await session.execute(
+                text("SELECT COLUMN_NAME FROM INFORMATION_SCHEMA.COLUMNS WHERE TABLE_NAME = 'uploaded_files' AND COLUMN_NAME = 'data_parquet'")
+            )
+            exists = result.scalar()
+
+            if not exists:
+                await session.execute(
+                    text("ALTER TABLE uploaded_files ADD COLUMN data_parquet MEDIUMBLOB NULL COMMENT '默认 sheet 解析结果的 Parquet 数据(MEDIUMBLOB)'")
+                )
+                await session.commit()
+                print("Migration: Added 'data_parquet' column to uploaded_files table")
+            else:
+                print("Migration: 'data_parquet' column already exists")
+        except Exception as e:
+            print(f"Migration error (data_parquet): {e}")
+            await session.rollback()
+
+        # 检查 uploaded_files.preview_json 列是否存在
+        try:
+            result = await session.execute(
+                text("SELECT COLUMN_NAME FROM INFORMATION_SCHEMA.COLUMNS WHERE TABLE_NAME = 'uploaded_files' AND COLUMN_NAME = 'preview_json'")
+            )
+            exists = result.scalar()
+
+            if not exists:
+                await session.execute(
+                    text("ALTER TABLE uploaded_files ADD COLUMN preview_json MEDIUMTEXT NULL COMMENT '默认 sheet 数据预览 JSON(MEDIUMTEXT)'")
+                )
+                await session.commit()
+                print("Migration: Added 'preview_json' column to uploaded_files table")
+            else:
+                print("Migration: 'preview_json' column already exists")
+        except Exception as e:
+            print(f"Migration error (preview_json): {e}")
+            await session.rollback()
+
+        # 检查 chat_messages.chart_config 列是否已是 JSON 类型
+        try:
+            result = await session.execute(
+                text("SELECT DATA_TYPE FROM INFORMATION_SCHEMA.COLUMNS WHERE TABLE_NAME = 'chat_messages' AND COLUMN_NAME = 'chart_config'")
+            )
+            data_type = result.scalar()
+
+            if data_type and data_type.lower() != "json":
+                # 无法解析的旧数据置空，否则修改列类型会失败
+                await session.execute(
+                    text("UPDATE chat_messages SET chart_config = NULL WHERE chart_config IS NOT NULL AND NOT JSON_VALID(chart_config)")
+                )
+                await session.execute(
+                    text("ALTER TABLE chat_messages MODIFY COLUMN chart_config JSON NULL COMMENT '图表配置JSON'")
+                )
+                await session.commit()
+                print("Migration: Changed 'chart_config' column to JSON")
+            else:
+                print("Migration: 'chart_config' column is already JSON")
+        except Exception as e:
+            print(f"Migration error (chart_config): {e}")
+            await session.rollback()
+
+        # 检查热点查询的索引是否存在
+        for table_name, index_name, columns in MIGRATION_INDEXES:
+            try:
+                result = await session.execute(
+                    text(
+                        "SELECT INDEX_NAME FROM INFORMATION_SCHEMA.STATISTICS "
+                        "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = :table_name AND INDEX_NAME = :index_name"
+                    ),
+                    {"table_name": table_name, "index_name": index_name}
+                )
+                exists = result.scalar()
+
+                if not exists:
+                    await session.execute(
+                        text(f"ALTER TABLE {table_name} ADD INDEX {index_name} ({columns})")
+                    )
+                    await session.commit()
+                    print(f"Migration: Added index '{index_name}' to {table_name} table")
+                else:
+                    print(f"Migration: index '{index_name}' already exists")
+            except Exception as e:
+                print(f"Migration error ({index_name}): {e}")
+                await session.rollback()
+
+        # 检查全文索引是否存在
+        for table_name, index_name, columns in MIGRATION_FULLTEXT_INDEXES:
+            try:
+                result = await session.execute(
+                    text(
+                        "SELECT INDEX_NAME FROM INFORMATION_SCHEMA.STATISTICS "
+                        "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = :table_name AND INDEX_NAME = :index_name"
+                    ),
+                    {"table_name": table_name, "index_name": index_name}
+                )
+                exists = result.scalar()
+
+                if not exists:
+                    await session.execute(
+                        text(f"ALTER TABLE {table_name} ADD FULLTEXT INDEX {index_name} ({columns}) WITH PARSER ngram")
+                    )
+                    await session.commit()
+                    print(f"Migration: Added fulltext index '{index_name}' to {table_name} table")
+                else:
+                    print(f"Migration: fulltext index '{index_name}' already exists")
+            except Exception as e:
+                print(f"Migration error ({index_name}): {e}")
+                await session.rollback()
+
 
 async def get_session() -> AsyncSession:
     """获取数据库会话"""
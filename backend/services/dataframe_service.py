@@ -0,0 +1,339 @@
+"""
+DataFrame 服务 - 文件解析，以及 Redis 缓存的序列化（Arrow IPC + zstd 压缩）
+"""
+import io
+import os
+import uuid
+import pickle
+import struct
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional, Union
+
+import orjson
+import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pacsv
+import pyarrow.parquet as pq
+import zstandard as zstd
+
+# 缓存格式标记（首字节），用于兼容旧的 pickle 缓存
+FORMAT_ARROW_ZSTD = b"A"
+FORMAT_PICKLE = b"P"
+FORMAT_PICKLE_OOB = b"O"
+
+# 带外缓冲区格式的头部：缓冲区数量，以及每个缓冲区的长度
+_OOB_COUNT = struct.Struct("<I")
+_OOB_LENGTH = struct.Struct("<Q")
+
+# 缓存的 zstd 压缩级别（低级别压缩速度快，缓存读写以网络传输为主）
+ZSTD_LEVEL = int(os.getenv("CACHE_ZSTD_LEVEL", 1))
+
+# pyarrow CSV 读取块大小
+CSV_BLOCK_SIZE = 8 << 20
+
+# Excel 解析引擎
+EXCEL_ENGINE = "calamine"
+
+# 数据预览行数
+PREVIEW_ROWS = 10
+
+_compressor = zstd.ZstdCompressor(level=ZSTD_LEVEL)
+_decompressor = zstd.ZstdDecompressor()
+
+
+def json_default(obj):
+    """
+    orjson 无法直接序列化的类型（pandas Timestamp 等）的处理
+    """
+    if hasattr(obj, "isoformat"):
+        return obj.isoformat()
+    return str(obj)
+
+
+def dumps_dataframe(df: pd.DataFrame) -> bytes:
+    """
+    序列化 DataFrame：优先 Arrow IPC + zstd，无法转换为 Arrow 时降级为 pickle
+    """
+    try:
+        table = pa.Table.from_pandas(df, preserve_index=True)
+    except (pa.ArrowInvalid, pa.ArrowTypeError, pa.ArrowNotImplementedError, ValueError, TypeError):
+        # 混合类型的 object 列、重复列名等无法转换为 Arrow
+        return FORMAT_PICKLE_OOB + _dumps_pickle_oob(df)
+    return FORMAT_ARROW_ZSTD + _compressor.compress(_table_to_ipc_bytes(table))
+
+
+def loads_dataframe(data: bytes) -> pd.DataFrame:
+    """
+    反序列化 DataFrame，兼容无格式标记的旧 pickle 缓存
+    """
+    tag = data[:1]
+    if tag == FORMAT_ARROW_ZSTD:
+        return _ipc_bytes_to_dataframe(_decompressor.decompress(data[1:]))
+    if tag == FORMAT_PICKLE_OOB:
+        # 复制到 bytearray：带外缓冲区引用可写内存，反序列化出的 numpy 数据块可修改（与 Arrow / pickle 路径一致）
+        return _loads_pickle_oob(memoryview(bytearray(data))[1:])
+    if tag == FORMAT_PICKLE:
+        return pickle.loads(data[1:])
+    return pickle.loads(data)
+
+
+def _dumps_pickle_oob(df: pd.DataFrame) -> bytes:
+    """
+    pickle protocol 5 序列化，numpy 数据块作为带外缓冲区直接拼接，不在 pickle 流中再复制一次
+    """
+    buffers = []
+    payload = pickle.dumps(df, protocol=5, buffer_callback=buffers.append)
+    raws = [buffer.raw() for buffer in buffers]
+    header = _OOB_COUNT.pack(len(raws)) + b"".join(_OOB_LENGTH.pack(raw.nbytes) for raw in raws)
+    return b"".join([header, *raws, payload])
+
+
+def _loads_pickle_oob(data: memoryview) -> pd.DataFrame:
+    """
+    反序列化 _dumps_pickle_oob 的结果，带外缓冲区以 memoryview 切片传入，不再逐个复制；
+    data 需是可写缓冲区的 memoryview，否则 numpy 数据块为只读
+    """
+    (count,) = _OOB_COUNT.unpack_from(data)
+    offset = _OOB_COUNT.size
+    lengths = []
+    for _ in range(count):
+        lengths.append(_OOB_LENGTH.unpack_from(data, offset)[0])
+        offset += _OOB_LENGTH.size
+    buffers = []
+    for length in lengths:
+        buffers.append(data[offset:offset + length])
+        offset += length
+    return pickle.loads(data[offset:], buffers=buffers)
+
+
+def _table_to_ipc_bytes(table: pa.Table) -> bytes:
+    """
+    Arrow Table 写为 IPC stream 字节
+    """
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue().to_pybytes()
+
+
+def _ipc_bytes_to_dataframe(data: bytes) -> pd.DataFrame:
+    """
+    读取 IPC stream 字节为 DataFrame（列缓冲区直接引用解压后的数据，不逐个单元格构造对象）
+    """
+    table = pa.ipc.open_stream(pa.BufferReader(data)).read_all()
+    return table.to_pandas(zero_copy_only=False)
+
+
+def read_csv_file(source: Union[str, bytes]) -> pd.DataFrame:
+    """
+    解析 CSV 文件（本地路径或文件内容）：优先使用 pyarrow 多线程 CSV 读取器，
+    解析失败时回退到 pandas 默认 C 引擎（本地文件使用 memory_map 读取）
+    """
+    try:
+        table = pacsv.read_csv(
+            pa.BufferReader(source) if isinstance(source, bytes) else source,
+            read_options=pacsv.ReadOptions(use_threads=True, block_size=CSV_BLOCK_SIZE),
+        )
+    except (pa.ArrowException, UnicodeDecodeError):
+        return _read_csv_pandas(source)
+    # 表头有重复列名时交给 pandas，与原来一样重命名为 a, a.1, a.2 ...
+    if len(set(table.column_names)) != table.num_columns:
+        return _read_csv_pandas(source)
+    return table.to_pandas(self_destruct=True)
+
+
+def _read_csv_pandas(source: Union[str, bytes]) -> pd.DataFrame:
+    if isinstance(source, bytes):
+        return pd.read_csv(io.BytesIO(source))
+    return pd.read_csv(source, memory_map=True)
+
+
+def open_excel(source: Union[str, bytes]) -> pd.ExcelFile:
+    """
+    打开 Excel 工作簿：优先使用 calamine（Rust 实现，xlsx/xls 都支持），未安装时回退到 pandas 默认引擎
+    """
+    try:
+        return pd.ExcelFile(_as_buffer(source), engine=EXCEL_ENGINE)
+    except ImportError:
+        return pd.ExcelFile(_as_buffer(source))
+
+
+def read_sheet_names(source: Union[str, bytes]) -> list:
+    """
+    读取 Excel 工作簿的 sheet 名称，读取后关闭工作簿
+    """
+    with open_excel(source) as excel_file:
+        return excel_file.sheet_names
+
+
+def downcast_dtypes(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    无损压缩数值列类型，减少内存占用和缓存体积：
+    整数列降为能容纳取值范围的最小整数类型，浮点列仅在所有值都能被 float32 精确表示时降级
+    """
+    # 按位置访问，兼容重复列名
+    for i in range(df.shape[1]):
+        series = df.iloc[:, i]
+        if pd.api.types.is_bool_dtype(series):
+            continue
+        if pd.api.types.is_integer_dtype(series):
+            df.isetitem(i, pd.to_numeric(series, downcast="integer"))
+        elif pd.api.types.is_float_dtype(series) and series.dtype != "float32":
+            downcast = series.astype("float32")
+            if (downcast.astype(series.dtype) == series)[series.notna()].all():
+                df.isetitem(i, downcast)
+    return df
+
+
+def parse_file(
+    source: Union[str, bytes],
+    file_type: str,
+    sheet_name: Optional[str] = None,
+    default_to_first_sheet: bool = False
+) -> tuple[bytes, list, Optional[str]]:
+    """
+    解析 CSV/Excel 文件（本地路径或文件内容），在解析进程池中执行。
+    Excel 只打开一次工作簿，未指定 sheet（或指定的 sheet 不存在且 default_to_first_sheet）时读取第一个。
+
+    Returns:
+        (dumps_dataframe 序列化结果, sheet 名称列表, 实际解析的 sheet)
+        结果以 Arrow IPC 字节跨进程返回，可直接写入 Redis 缓存
+    """
+    sheet_names = []
+    selected_sheet = None
+    if file_type == "csv":
+        df = read_csv_file(source)
+    else:
+        with open_excel(source) as excel_file:
+            sheet_names = excel_file.sheet_names
+            selected_sheet = sheet_name
+            if not sheet_name or (default_to_first_sheet and sheet_name not in sheet_names):
+                selected_sheet = sheet_names[0]
+            df = excel_file.parse(sheet_name=selected_sheet)
+    return dumps_dataframe(downcast_dtypes(df)), sheet_names, selected_sheet
+
+
+def read_parquet_cache(path: str) -> Optional[pd.DataFrame]:
+    """
+    读取 Parquet 缓存，文件不存在或损坏时返回 None。
+    命中时更新修改时间，本地存储清理时按最近使用保留
+    """
+    try:
+        df = _table_to_dataframe(pq.read_table(path, memory_map=True))
+    except (OSError, pa.ArrowException):
+        return None
+    try:
+        os.utime(path)
+    except OSError:
+        pass
+    return df
+
+
+def dumps_parquet(df: pd.DataFrame) -> Optional[bytes]:
+    """
+    序列化 DataFrame 为 Parquet（zstd 压缩），无法转换的 DataFrame（如非字符串列名）返回 None
+    """
+    try:
+        return df.to_parquet(engine="pyarrow", compression="zstd")
+    except (ValueError, TypeError, pa.ArrowException):
+        return None
+
+
+def loads_parquet(data: bytes) -> pd.DataFrame:
+    """
+    反序列化 Parquet 字节为 DataFrame（BufferReader 直接引用 bytes，不再复制到 BytesIO）
+    """
+    return _table_to_dataframe(pq.read_table(pa.BufferReader(data)))
+
+
+def _table_to_dataframe(table: pa.Table) -> pd.DataFrame:
+    """
+    Arrow Table 转为 DataFrame：按列拆分数据块（不合并成二维数组），
+    转换过程中释放已转换列的 Arrow 内存，降低峰值内存
+    """
+    return table.to_pandas(split_blocks=True, self_destruct=True)
+
+
+def write_parquet_cache(df: pd.DataFrame, path: str, data: Optional[bytes] = None) -> bool:
+    """
+    写入 Parquet 缓存（已序列化时直接传入 data），无法转换的 DataFrame 跳过
+    """
+    if data is None:
+        data = dumps_parquet(df)
+        if data is None:
+            return False
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+    return True
+
+
+def _as_buffer(source: Union[str, bytes]):
+    return io.BytesIO(source) if isinstance(source, bytes) else source
+
+
+def dumps_meta(df: pd.DataFrame) -> bytes:
+    """
+    生成 DataFrame 元信息的 JSON：{"columns": [...], "rows": N}
+    """
+    return orjson.dumps({"columns": df.columns.tolist(), "rows": len(df)}, default=json_default)
+
+
+def dumps_preview(df: pd.DataFrame, rows: int = PREVIEW_ROWS) -> bytes:
+    """
+    生成数据预览的 JSON（records 格式），NaN 替换为空字符串
+    """
+    records = df.head(rows).fillna("").to_dict(orient="records")
+    return orjson.dumps(
+        records,
+        default=json_default,
+        option=orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY,
+    )
+
+
+class DataFrameLRUCache:
+    """
+    按内存占用淘汰的 DataFrame LRU 缓存（Redis 不可用时的本地降级方案），
+    指定 ttl（秒）时条目过期后视为未命中
+    """
+
+    def __init__(self, max_bytes: int, ttl: Optional[float] = None):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._items: OrderedDict[str, tuple[pd.DataFrame, int, float]] = OrderedDict()
+        self._total_bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[pd.DataFrame]:
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                return None
+            if item[2] < time.monotonic():
+                del self._items[key]
+                self._total_bytes -= item[1]
+                return None
+            self._items.move_to_end(key)
+            return item[0]
+
+    def set(self, key: str, df: pd.DataFrame):
+        nbytes = int(df.memory_usage(deep=True).sum())
+        expires_at = time.monotonic() + self.ttl if self.ttl else float("inf")
+        with self._lock:
+            old = self._items.pop(key, None)
+            if old is not None:
+                self._total_bytes -= old[1]
+
+            # 超过总预算的单个 DataFrame 不缓存
+            if nbytes > self.max_bytes:
+                return
+
+            self._items[key] = (df, nbytes, expires_at)
+            self._total_bytes += nbytes
+            while self._total_bytes > self.max_bytes:
+                _, (_, evicted_bytes, _) = self._items.popitem(last=False)
+                self._total_bytes -= evicted_bytes
@@ -1,7 +1,10 @@
 import os
-import json
 import re
+import logging
+import orjson
+import time
 import asyncio
+from collections import OrderedDict
 from typing import List, Optional, AsyncGenerator
 from dotenv import load_dotenv
 from langchain.chat_models import init_chat_model
@@ -10,6 +13,8 @@ from langchain_openai import ChatOpenAI
 
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
 # # 初始化 DeepSeek 模型
 # model = init_chat_model(
 #     "deepseek-chat",
@@ -28,6 +33,39 @@ model = ChatOpenAI(
 LLM_MAX_CONCURRENT = int(os.getenv("LLM_MAX_CONCURRENT", 10))
 llm_semaphore = asyncio.Semaphore(LLM_MAX_CONCURRENT)
 
+
+class AsyncTokenBucket:
+    """
+    异步令牌桶：按 rate（个/秒）补充令牌，最多积累 capacity 个，令牌不足时等待
+    """
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    async def acquire(self, n: float = 1):
+        # 加锁保证等待中的请求按先后顺序获取令牌
+        async with self._lock:
+            self._refill()
+            while self.tokens < n:
+                await asyncio.sleep((n - self.tokens) / self.rate)
+                self._refill()
+            self.tokens -= n
+
+
+# LLM 每分钟请求数限制（令牌桶，允许 LLM_BURST 个请求的突发），0 表示不限制
+LLM_RPM = int(os.getenv("LLM_RPM", 0))
+LLM_BURST = int(os.getenv("LLM_BURST", max(LLM_RPM // 6, 1)))
+llm_bucket = AsyncTokenBucket(rate=LLM_RPM / 60, capacity=LLM_BURST) if LLM_RPM > 0 else None
+
 CHART_SYSTEM_PROMPT = """你是一个专业的数据可视化专家和数据分析助手。你可以：
 1. 根据用户提供的表格数据和需求描述，生成 ECharts 图表配置
 2. 回答用户关于数据的问题
@@ -158,62 +196,89 @@ CHART_SYSTEM_PROMPT = """你是一个专业的数据可视化专家和数据分
 """
 
 
-def chat_with_context_multi_files(
-    files_data: List[dict],
-    user_prompt: str,
-    history_messages: List[dict]
-) -> dict:
-    """
-    支持多文件的多轮对话函数
+# 回复中的代码块（图表配置），模块加载时编译一次
+_CHART_RE = re.compile(r'```(?:json)?\s*(.*?)\s*```', re.DOTALL)
 
-    Args:
-        files_data: 文件数据列表，格式 [{"file_id": "...", "filename": "...", "columns": [...], "data": "..."}]
-        user_prompt: 用户的当前消息
-        history_messages: 历史消息列表，格式 [{"role": "user/assistant", "content": "..."}]
+# ECharts option 的顶层配置项，用于在多个代码块中识别图表配置
+_CHART_OPTION_KEYS = ("series", "xAxis", "yAxis", "dataset")
 
-    Returns:
-        {"content": "回复内容", "chart_config": dict或None}
-    """
-    # 构建消息列表
-    messages: List[BaseMessage] = [SystemMessage(content=CHART_SYSTEM_PROMPT)]
+# 固定的系统提示消息，模块加载时创建一次
+_SYSTEM_MSG = SystemMessage(content=CHART_SYSTEM_PROMPT)
 
-    # 如果有文件数据，添加多文件数据上下文
-    if files_data:
-        if len(files_data) == 1:
-            # 单文件
-            file_info = files_data[0]
-            data_context = f"""
+# 已渲染的文件数据上下文消息（按数据源 ID 组合缓存，文件内容上传后不可变）
+DATA_CONTEXT_CACHE_SIZE = int(os.getenv("DATA_CONTEXT_CACHE_SIZE", 128))
+_data_context_cache: "OrderedDict[tuple, List[SystemMessage]]" = OrderedDict()
+
+
+def _build_data_context(files_data: List[dict]) -> List[str]:
+    """
+    构建文件数据上下文（单文件 / 多文件），每个文件一段，分别作为独立的系统消息发送，
+    不再拼接成一个大字符串
+    """
+    if len(files_data) == 1:
+        # 单文件
+        file_info = files_data[0]
+        return [f"""
 ## 当前表格数据信息
 
 文件名: {file_info['filename']}
 列名: {file_info['columns']}
 
-完整数据:
+数据概览（字段类型及样本数据）:
 {file_info['data']}
 
 请基于以上数据回答用户问题或生成图表。
-"""
-        else:
-            # 多文件
-            data_context = f"""
-## 当前有 {len(files_data)} 个数据文件
+"""]
 
-"""
-            for i, file_info in enumerate(files_data, 1):
-                data_context += f"""
+    # 多文件
+    parts = [f"""
+## 当前有 {len(files_data)} 个数据文件
+"""]
+    parts.extend(f"""
 ### 文件{i}: {file_info['filename']}
 列名: {file_info['columns']}
 
-数据:
+数据概览（字段类型及样本数据）:
 {file_info['data']}
-
----
-"""
-            data_context += """
+""" for i, file_info in enumerate(files_data, 1))
+    parts.append("""
 请基于以上多个文件的数据回答用户问题或生成图表。
 如果用户需要对比分析，可以将多个文件的数据放在同一图表中展示。
-"""
-        messages.append(SystemMessage(content=data_context))
+""")
+    return parts
+
+
+def _get_data_context_messages(files_data: List[dict]) -> List[SystemMessage]:
+    """
+    获取文件数据上下文的系统消息：同一组数据源在多轮对话中内容相同，渲染一次后复用
+    """
+    key = tuple(file_info["file_id"] for file_info in files_data)
+    messages = _data_context_cache.get(key)
+    if messages is not None:
+        _data_context_cache.move_to_end(key)
+        return messages
+
+    messages = [SystemMessage(content=part) for part in _build_data_context(files_data)]
+    _data_context_cache[key] = messages
+    if len(_data_context_cache) > DATA_CONTEXT_CACHE_SIZE:
+        _data_context_cache.popitem(last=False)
+    return messages
+
+
+def _build_messages(
+    files_data: List[dict],
+    user_prompt: str,
+    history_messages: List[dict]
+) -> List[BaseMessage]:
+    """
+    构建发送给模型的消息列表：系统提示 + 文件数据上下文 + 历史消息 + 当前用户消息
+    """
+    messages: List[BaseMessage] = [_SYSTEM_MSG]
+
+    # 如果有文件数据，添加多文件数据上下文（每个文件一条系统消息），
+    # 紧跟固定的系统提示，保持各轮请求的消息前缀一致，便于服务端前缀缓存命中
+    if files_data:
+        messages.extend(_get_data_context_messages(files_data))
 
     # 添加历史消息
     for msg in history_messages:
@@ -226,30 +291,44 @@ def chat_with_context_multi_files(
 
     # 添加当前用户消息
     messages.append(HumanMessage(content=user_prompt))
+    return messages
+
+
+async def chat_with_context_multi_files(
+    files_data: List[dict],
+    user_prompt: str,
+    history_messages: List[dict]
+) -> dict:
+    """
+    支持多文件的多轮对话函数
 
-    # 调用模型
+    Args:
+        files_data: 文件数据列表，格式 [{"file_id": "...", "filename": "...", "columns": [...], "data": "..."}]
+        user_prompt: 用户的当前消息
+        history_messages: 历史消息列表，格式 [{"role": "user/assistant", "content": "..."}]
+
+    Returns:
+        {"content": "回复内容", "chart_config": dict或None}
+    """
+    messages = _build_messages(files_data, user_prompt, history_messages)
+
+    # 异步调用模型，带并发限流和请求速率限制（不阻塞事件循环）
     try:
-        response = model.invoke(messages)
+        async with llm_semaphore:
+            if llm_bucket:
+                await llm_bucket.acquire()
+            response = await model.ainvoke(messages)
         content = str(response.content)
     except Exception as e:
-        print(f"LLM调用失败: {str(e)}")
-        print(f"LLM配置 - base_url: {model.openai_api_base}")
-        print(f"LLM配置 - model: {model.model_name}")
+        logger.error(
+            "LLM调用失败: %s (base_url: %s, model: %s)",
+            e, model.openai_api_base, model.model_name
+        )
         raise
 
-    # 尝试提取图表配置
-    chart_config = None
-    json_match = re.search(r'```(?:json)?\s*([\s\S]*?)\s*```', content)
-    if json_match:
-        json_str = json_match.group(1)
-        try:
-            chart_config = json.loads(json_str)
-        except json.JSONDecodeError:
-            pass
-
     return {
         "content": content,
-        "chart_config": chart_config
+        "chart_config": extract_chart_config(content)
     }
 
 
@@ -269,128 +348,172 @@ async def stream_chat_multi_files(
     Yields:
         流式输出的文本片段
     """
-    # 构建消息列表
-    messages: List[BaseMessage] = [SystemMessage(content=CHART_SYSTEM_PROMPT)]
-
-    # 如果有文件数据，添加多文件数据上下文
-    if files_data:
-        if len(files_data) == 1:
-            # 单文件
-            file_info = files_data[0]
-            data_context = f"""
-## 当前表格数据信息
-
-文件名: {file_info['filename']}
-列名: {file_info['columns']}
-
-完整数据:
-{file_info['data']}
-
-请基于以上数据回答用户问题或生成图表。
-"""
-        else:
-            # 多文件
-            data_context = f"""
-## 当前有 {len(files_data)} 个数据文件
-
-"""
-            for i, file_info in enumerate(files_data, 1):
-                data_context += f"""
-### 文件{i}: {file_info['filename']}
-列名: {file_info['columns']}
-
-数据:
-{file_info['data']}
-
----
-"""
-            data_context += """
-请基于以上多个文件的数据回答用户问题或生成图表。
-如果用户需要对比分析，可以将多个文件的数据放在同一图表中展示。
-"""
-        messages.append(SystemMessage(content=data_context))
-
-    # 添加历史消息
-    for msg in history_messages:
-        role = msg.get("role", "user")
-        content = msg.get("content", "")
-        if role == "user":
-            messages.append(HumanMessage(content=content))
-        elif role == "assistant":
-            messages.append(AIMessage(content=content))
-
-    # 添加当前用户消息
-    messages.append(HumanMessage(content=user_prompt))
+    messages = _build_messages(files_data, user_prompt, history_messages)
 
-    # 使用 astream 流式输出，带并发限流
+    # 使用 astream 流式输出，带并发限流和请求速率限制
     async with llm_semaphore:
+        if llm_bucket:
+            await llm_bucket.acquire()
         async for chunk in model.astream(messages):
-            if hasattr(chunk, 'content') and chunk.content:
-                content = chunk.content
-                if isinstance(content, str):
+            content = getattr(chunk, 'content', None)
+            # 快速路径：绝大多数片段的内容是字符串
+            if isinstance(content, str):
+                if content:
                     yield content
-                elif isinstance(content, list):
-                    # 处理可能的列表类型内容
-                    for item in content:
-                        if isinstance(item, str):
-                            yield item
-                        elif isinstance(item, dict) and 'text' in item:
-                            yield str(item['text'])
+                continue
+            if not isinstance(content, list):
+                continue
+            # 处理可能的列表类型内容
+            for item in content:
+                if isinstance(item, str):
+                    yield item
+                elif isinstance(item, dict) and 'text' in item:
+                    yield str(item['text'])
 
 
 def extract_chart_config(content: str) -> Optional[dict]:
     """
-    从回复内容中提取图表配置
+    从回复内容中提取图表配置：回复中有多个代码块时，优先返回第一个 ECharts 配置，
+    都不像 ECharts 配置时返回第一个能解析的 JSON
+    """
+    # 回复中没有代码块时跳过正则匹配
+    if "```" not in content:
+        return None
+    fallback = None
+    for json_match in _CHART_RE.finditer(content):
+        parsed = _parse_chart_json(json_match.group(1))
+        if parsed is None:
+            continue
+        if _is_chart_option(parsed):
+            return parsed
+        if fallback is None:
+            fallback = parsed
+    return fallback
+
+
+def _is_chart_option(obj) -> bool:
+    """
+    是否像 ECharts option（包含图表数据相关的顶层配置项）
+    """
+    return isinstance(obj, dict) and any(key in obj for key in _CHART_OPTION_KEYS)
+
+
+def _parse_chart_json(json_str: str) -> Optional[dict]:
+    """
+    解析代码块中的图表 JSON，失败时移除 JavaScript 函数后重试
     """
-    json_match = re.search(r'```(?:json)?\s*([\s\S]*?)\s*```', content)
-    if json_match:
-        json_str = json_match.group(1)
+    try:
+        return orjson.loads(json_str)
+    except orjson.JSONDecodeError:
+        # 尝试移除 JavaScript 函数后再解析
+        cleaned_json = _remove_js_functions(json_str)
         try:
-            return json.loads(json_str)
-        except json.JSONDecodeError:
-            # 尝试移除 JavaScript 函数后再解析
-            cleaned_json = _remove_js_functions(json_str)
-            try:
-                return json.loads(cleaned_json)
-            except json.JSONDecodeError:
-                pass
+            return orjson.loads(cleaned_json)
+        except orjson.JSONDecodeError:
+            pass
     return None
 
 
+class StreamingChartExtractor:
+    """
+    流式回复的图表配置提取器：逐个片段查找代码块的开始/结束标记，
+    只扫描新到达的片段（保留上一片段末尾 2 个字符处理跨片段的标记），
+    每个代码块结束时解析一次 JSON，找到 ECharts 配置后不再扫描，
+    结果与 extract_chart_config(完整回复) 一致
+    """
+
+    _FENCE = "```"
+
+    def __init__(self):
+        self._open = False
+        self._done = False
+        self._tail = ""
+        self._body: List[str] = []
+        self._chart: Optional[dict] = None
+        self._fallback: Optional[dict] = None
+
+    def feed(self, chunk: str):
+        while not self._done:
+            if not self._open:
+                text = self._tail + chunk
+                start = text.find(self._FENCE)
+                if start < 0:
+                    self._tail = text[-2:]
+                    return
+                self._open = True
+                self._tail = ""
+                chunk = text[start + 3:]
+
+            # 代码块内：在上一片段末尾 + 当前片段中查找结束标记
+            text = self._tail + chunk
+            end = text.find(self._FENCE)
+            if end < 0:
+                self._body.append(chunk)
+                self._tail = text[-2:]
+                return
+
+            body = "".join(self._body) + chunk
+            body = body[:len(body) - len(text) + end]
+            self._open = False
+            self._tail = ""
+            self._body = []
+            self._accept(body)
+            # 结束标记之后的内容继续查找下一个代码块
+            chunk = text[end + 3:]
+
+    def _accept(self, body: str):
+        if body.startswith("json"):
+            body = body[4:]
+        parsed = _parse_chart_json(body.strip())
+        if parsed is None:
+            return
+        if _is_chart_option(parsed):
+            self._chart = parsed
+            self._done = True
+        elif self._fallback is None:
+            self._fallback = parsed
+
+    def result(self) -> Optional[dict]:
+        """流式结束后的图表配置"""
+        return self._chart if self._chart is not None else self._fallback
+
+
 def _remove_js_functions(json_str: str) -> str:
     """
     移除 JSON 字符串中的 JavaScript 函数定义，替换为 null
     处理类似: "color": function(params) { ... } 的情况
+    用 str.find 跳到下一个 function 关键字和大括号，按切片拼接结果，不逐字符处理
     """
-    # 匹配 function(...) { ... } 模式，包括嵌套大括号
     result = []
     i = 0
-    while i < len(json_str):
-        # 检查是否是 function 关键字
-        if json_str[i:i+8] == 'function':
-            # 找到函数开始，需要找到对应的结束大括号
-            j = i + 8
-            # 跳过参数部分 (...)
-            while j < len(json_str) and json_str[j] != '{':
-                j += 1
-            if j < len(json_str):
-                # 找到函数体的结束位置
-                brace_count = 1
-                j += 1
-                while j < len(json_str) and brace_count > 0:
-                    if json_str[j] == '{':
-                        brace_count += 1
-                    elif json_str[j] == '}':
-                        brace_count -= 1
-                    j += 1
-                # 用 null 替换整个函数
-                result.append('null')
-                i = j
+    n = len(json_str)
+    while True:
+        start = json_str.find('function', i)
+        if start < 0:
+            break
+        # 跳过参数部分 (...)，找到函数体的开始
+        j = json_str.find('{', start + 8)
+        if j < 0:
+            break
+        # 找到函数体的结束位置（包括嵌套大括号）
+        brace_count = 1
+        j += 1
+        while j < n and brace_count > 0:
+            open_pos = json_str.find('{', j)
+            close_pos = json_str.find('}', j)
+            if close_pos < 0:
+                j = n
+                break
+            if 0 <= open_pos < close_pos:
+                brace_count += 1
+                j = open_pos + 1
             else:
-                result.append(json_str[i])
-                i += 1
-        else:
-            result.append(json_str[i])
-            i += 1
+                brace_count -= 1
+                j = close_pos + 1
+        # 用 null 替换整个函数
+        result.append(json_str[i:start])
+        result.append('null')
+        i = j
+    result.append(json_str[i:])
 
     return ''.join(result)
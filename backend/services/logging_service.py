@@ -0,0 +1,54 @@
+"""
+日志服务 - 日志记录通过队列交给后台线程输出，请求处理中写日志不会阻塞在 stderr / 容器日志管道上
+"""
+import os
+import queue
+import logging
+from logging.handlers import QueueHandler, QueueListener
+from typing import Optional
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = "%(asctime)s %(levelname)s %(name)s: %(message)s"
+
+_listener: Optional[QueueListener] = None
+_queue_handler: Optional[QueueHandler] = None
+# setup_logging 之前根日志器的级别，stop_logging 时恢复
+_previous_level: Optional[int] = None
+
+
+def setup_logging():
+    """
+    配置根日志器：QueueHandler 只把日志记录放入队列，由 QueueListener 的后台线程写到 stderr
+    """
+    global _listener, _queue_handler, _previous_level
+    if _listener is not None:
+        return
+
+    log_queue: queue.Queue = queue.Queue(-1)
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    _listener = QueueListener(log_queue, stream_handler, respect_handler_level=True)
+    _listener.start()
+
+    root = logging.getLogger()
+    _previous_level = root.level
+    _queue_handler = QueueHandler(log_queue)
+    root.addHandler(_queue_handler)
+    root.setLevel(LOG_LEVEL)
+
+
+def stop_logging():
+    """
+    停止后台日志线程（输出队列中剩余的日志），并从根日志器移除 QueueHandler、恢复原来的级别
+    """
+    global _listener, _queue_handler, _previous_level
+    if _listener is None:
+        return
+    # 先移除 QueueHandler，之后的日志不会再进入已停止的队列
+    root = logging.getLogger()
+    root.removeHandler(_queue_handler)
+    root.setLevel(_previous_level)
+    _listener.stop()
+    _listener = None
+    _queue_handler = None
+    _previous_level = None
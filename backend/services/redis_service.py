@@ -2,29 +2,54 @@
 Redis 缓存服务 - 替代内存缓存，支持多进程共享
 """
 import os
-import pickle
+import uuid
+import logging
+import asyncio
 import hashlib
-from typing import Optional
+from typing import Optional, List
+import orjson
+import zstandard as zstd
 import redis.asyncio as redis
 from dotenv import load_dotenv
 
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
 # Redis 配置
 REDIS_HOST = os.getenv("REDIS_HOST", "localhost")
 REDIS_PORT = int(os.getenv("REDIS_PORT", 6379))
 REDIS_PASSWORD = os.getenv("REDIS_PASSWORD", None)
 REDIS_DB = int(os.getenv("REDIS_DB", 0))
+# 完整连接地址（如 redis://:password@host:6379/0），设置后优先于上面的单项配置
+REDIS_URL = os.getenv("REDIS_URL")
+REDIS_MAX_CONNECTIONS = int(os.getenv("REDIS_MAX_CONNECTIONS", 50))
+# 连接池耗尽时等待空闲连接的超时时间（秒）
+REDIS_POOL_TIMEOUT = float(os.getenv("REDIS_POOL_TIMEOUT", 5))
+# 空闲连接的健康检查间隔（秒），及时丢弃已断开的连接
+REDIS_HEALTH_CHECK_INTERVAL = int(os.getenv("REDIS_HEALTH_CHECK_INTERVAL", 30))
 
-# 创建 Redis 连接池
-redis_pool = redis.ConnectionPool(
-    host=REDIS_HOST,
-    port=REDIS_PORT,
-    password=REDIS_PASSWORD,
-    db=REDIS_DB,
-    max_connections=50,
-    decode_responses=False,  # 二进制模式，支持 pickle
-)
+# 创建进程级共享的 Redis 连接池，所有缓存操作复用同一个客户端。
+# 使用 BlockingConnectionPool：并发突增时请求排队等待连接，而不是直接抛出连接数超限错误
+if REDIS_URL:
+    redis_pool = redis.BlockingConnectionPool.from_url(
+        REDIS_URL,
+        max_connections=REDIS_MAX_CONNECTIONS,
+        timeout=REDIS_POOL_TIMEOUT,
+        health_check_interval=REDIS_HEALTH_CHECK_INTERVAL,
+        decode_responses=False,
+    )
+else:
+    redis_pool = redis.BlockingConnectionPool(
+        host=REDIS_HOST,
+        port=REDIS_PORT,
+        password=REDIS_PASSWORD,
+        db=REDIS_DB,
+        max_connections=REDIS_MAX_CONNECTIONS,
+        timeout=REDIS_POOL_TIMEOUT,
+        health_check_interval=REDIS_HEALTH_CHECK_INTERVAL,
+        decode_responses=False,  # 二进制模式，支持序列化后的 DataFrame
+    )
 
 # Redis 客户端
 redis_client = redis.Redis(connection_pool=redis_pool)
@@ -32,27 +57,88 @@ redis_client = redis.Redis(connection_pool=redis_pool)
 # 缓存过期时间（秒）
 CACHE_TTL = 3600  # 1小时
 
+# DataFrame 缓存分块读取的块大小（字节）
+DATAFRAME_CHUNK_SIZE = int(os.getenv("DATAFRAME_CHUNK_SIZE", 4 << 20))
+
+# JSON 缓存值超过该大小（字节）时使用 zstd 压缩，小值压缩收益不大
+CACHE_COMPRESS_MIN_BYTES = int(os.getenv("CACHE_COMPRESS_MIN_BYTES", 1024))
+# zstd 帧的魔数，用于区分压缩值和未压缩的 JSON（兼容已有缓存）
+_ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+_json_compressor = zstd.ZstdCompressor(level=1)
+_json_decompressor = zstd.ZstdDecompressor()
+
+# 会话消息缓存的格式标记（首字节），用于区分旧的 pickle 缓存
+SESSION_MESSAGES_FORMAT_JSON = b"j"
+
+# 缓存填充锁（single-flight）：锁过期时间（秒）、等待缓存写入的轮询间隔（秒）和次数
+FILL_LOCK_TTL = 5
+FILL_WAIT_INTERVAL = 0.05
+FILL_WAIT_RETRIES = 20
+
+# 只删除自己持有的锁（token 一致时才删除），避免锁过期后误删其他请求的锁
+_release_lock_script = redis_client.register_script(
+    "if redis.call('get', KEYS[1]) == ARGV[1] then return redis.call('del', KEYS[1]) end return 0"
+)
+
+
+def dumps_cache_json(obj) -> bytes:
+    """
+    orjson 序列化缓存值，超过 CACHE_COMPRESS_MIN_BYTES 时使用 zstd（level 1）压缩
+    """
+    data = orjson.dumps(obj)
+    if len(data) >= CACHE_COMPRESS_MIN_BYTES:
+        return _json_compressor.compress(data)
+    return data
+
 
-async def get_cached_dataframe(file_id: str) -> Optional[bytes]:
+def loads_cache_json(data: bytes):
     """
-    从 Redis 获取缓存的 DataFrame（pickle 序列化后的二进制）
+    反序列化 dumps_cache_json 的结果（按 zstd 魔数判断是否压缩）
     """
+    if data[:4] == _ZSTD_MAGIC:
+        data = _json_decompressor.decompress(data)
+    return orjson.loads(data)
+
+
+async def get_cached_dataframe(file_id: str, ttl: int = CACHE_TTL) -> Optional[bytes]:
+    """
+    从 Redis 获取缓存的 DataFrame（序列化后的二进制，见 dataframe_service），读取的同时刷新过期时间。
+    第一个 pipeline 读取前 DATAFRAME_CHUNK_SIZE 字节和总长度，较大的缓存再用 GETRANGE 分块读取，
+    每块之间让出事件循环，避免单个大 GET 阻塞其他请求
+    """
+    key = f"df:{file_id}"
     try:
-        data = await redis_client.get(f"df:{file_id}")
-        return data
+        async with redis_client.pipeline(transaction=False) as pipe:
+            pipe.getrange(key, 0, DATAFRAME_CHUNK_SIZE - 1)
+            pipe.strlen(key)
+            pipe.expire(key, ttl)
+            first, size, _ = await pipe.execute()
+        if not size:
+            return None
+        if size <= len(first):
+            return first
+
+        chunks = [first]
+        for offset in range(len(first), size, DATAFRAME_CHUNK_SIZE):
+            chunks.append(await redis_client.getrange(key, offset, offset + DATAFRAME_CHUNK_SIZE - 1))
+        data = b"".join(chunks)
+        # 分块读取期间缓存被覆盖时长度不一致，视为未命中
+        return data if len(data) == size else None
     except Exception as e:
-        print(f"Redis get error: {e}")
+        logger.warning("Redis get error: %s", e)
         return None
 
 
-async def set_cached_dataframe(file_id: str, df_bytes: bytes, ttl: int = CACHE_TTL):
+async def set_cached_dataframe(file_id: str, df_bytes: bytes, ttl: int = CACHE_TTL) -> bool:
     """
-    缓存 DataFrame 到 Redis
+    缓存 DataFrame 到 Redis，返回是否写入成功（失败时调用方降级到本地缓存）
     """
     try:
         await redis_client.setex(f"df:{file_id}", ttl, df_bytes)
+        return True
     except Exception as e:
-        print(f"Redis set error: {e}")
+        logger.warning("Redis set error: %s", e)
+        return False
 
 
 async def delete_cached_dataframe(file_id: str):
@@ -62,20 +148,100 @@ async def delete_cached_dataframe(file_id: str):
     try:
         await redis_client.delete(f"df:{file_id}")
     except Exception as e:
-        print(f"Redis delete error: {e}")
+        logger.warning("Redis delete error: %s", e)
+
+
+async def get_cached_sheet_names(file_id: str) -> Optional[list]:
+    """
+    从 Redis 获取缓存的 Excel sheet 名称列表
+    """
+    try:
+        data = await redis_client.get(f"file:{file_id}:sheets")
+        if data:
+            return orjson.loads(data)
+        return None
+    except Exception as e:
+        logger.warning("Redis get sheets error: %s", e)
+        return None
+
+
+async def set_cached_sheet_names(file_id: str, sheet_names: list, ttl: int = CACHE_TTL):
+    """
+    缓存 Excel sheet 名称列表到 Redis
+    """
+    try:
+        await redis_client.setex(f"file:{file_id}:sheets", ttl, orjson.dumps(sheet_names))
+    except Exception as e:
+        logger.warning("Redis set sheets error: %s", e)
+
+
+async def get_cached_summary(cache_key: str, ttl: int = CACHE_TTL) -> tuple[Optional[bytes], Optional[bytes]]:
+    """
+    从 Redis 获取缓存的 DataFrame 元信息 JSON（列名、行数）和数据预览 JSON，
+    两个 GETEX 在同一个 pipeline 中一次往返，读取的同时刷新过期时间
+    """
+    try:
+        async with redis_client.pipeline(transaction=False) as pipe:
+            pipe.getex(f"file:{cache_key}:meta", ex=ttl)
+            pipe.getex(f"file:{cache_key}:preview", ex=ttl)
+            meta_json, preview_json = await pipe.execute()
+        return meta_json, preview_json
+    except Exception as e:
+        logger.warning("Redis get summary error: %s", e)
+        return None, None
+
+
+async def set_cached_summary(cache_key: str, meta_json: bytes, preview_json: bytes, ttl: int = CACHE_TTL):
+    """
+    缓存 DataFrame 元信息 JSON 和数据预览 JSON 到 Redis（pipeline 一次往返写入）
+    """
+    try:
+        async with redis_client.pipeline(transaction=False) as pipe:
+            pipe.setex(f"file:{cache_key}:meta", ttl, meta_json)
+            pipe.setex(f"file:{cache_key}:preview", ttl, preview_json)
+            await pipe.execute()
+    except Exception as e:
+        logger.warning("Redis set summary error: %s", e)
+
+
+async def get_cached_llm_contexts(cache_keys: List[str], variant: str, ttl: int = CACHE_TTL) -> List[Optional[bytes]]:
+    """
+    批量获取缓存的 LLM 上下文 JSON（GETEX 放在同一个 pipeline 中一次往返，同时刷新过期时间），
+    variant 为上下文格式版本和构建参数，未命中或出错的位置为 None
+    """
+    if not cache_keys:
+        return []
+    try:
+        async with redis_client.pipeline(transaction=False) as pipe:
+            for cache_key in cache_keys:
+                pipe.getex(f"file:{cache_key}:context:{variant}", ex=ttl)
+            return await pipe.execute()
+    except Exception as e:
+        logger.warning("Redis mget context error: %s", e)
+        return [None] * len(cache_keys)
+
+
+async def set_cached_llm_context(cache_key: str, variant: str, context_json: bytes, ttl: int = CACHE_TTL):
+    """
+    缓存 LLM 上下文 JSON 到 Redis（文件内容不可变，与 DataFrame 缓存同样的过期时间）
+    """
+    try:
+        await redis_client.setex(f"file:{cache_key}:context:{variant}", ttl, context_json)
+    except Exception as e:
+        logger.warning("Redis set context error: %s", e)
 
 
 async def get_cached_session_messages(session_id: str) -> Optional[list]:
     """
-    从 Redis 获取缓存的会话消息
+    从 Redis 获取缓存的会话消息（orjson 编码），旧的 pickle 缓存视为未命中，由调用方重新写入
     """
     try:
         data = await redis_client.get(f"session:{session_id}:messages")
-        if data:
-            return pickle.loads(data)
+        if data and data[:1] == SESSION_MESSAGES_FORMAT_JSON:
+            return orjson.loads(memoryview(data)[1:])
         return None
     except Exception as e:
-        print(f"Redis get session error: {e}")
+        logger.warning("Redis get session error: %s", e)
         return None
 
 
@@ -84,9 +250,13 @@ async def set_cached_session_messages(session_id: str, messages: list, ttl: int
     缓存会话消息到 Redis（30分钟过期）
     """
     try:
-        await redis_client.setex(f"session:{session_id}:messages", ttl, pickle.dumps(messages))
+        await redis_client.setex(
+            f"session:{session_id}:messages",
+            ttl,
+            SESSION_MESSAGES_FORMAT_JSON + orjson.dumps(messages, default=str),
+        )
     except Exception as e:
-        print(f"Redis set session error: {e}")
+        logger.warning("Redis set session error: %s", e)
 
 
 async def invalidate_session_cache(session_id: str):
@@ -96,7 +266,41 @@ async def invalidate_session_cache(session_id: str):
     try:
         await redis_client.delete(f"session:{session_id}:messages")
     except Exception as e:
-        print(f"Redis invalidate error: {e}")
+        logger.warning("Redis invalidate error: %s", e)
+
+
+async def wait_for_cache_fill(cache_key: str) -> tuple[Optional[bytes], Optional[str]]:
+    """
+    缓存未命中时的 single-flight，避免缓存过期瞬间大量请求同时查询数据库：
+    抢到填充锁返回 (None, token)，调用方查询数据库、写入缓存后调用 release_fill_lock；
+    锁被其他请求持有时轮询等待缓存写入，等到则返回 (缓存内容, None)；
+    等待超时或 Redis 不可用时返回 (None, None)，调用方直接查询数据库
+    """
+    lock_key = f"lock:{cache_key}"
+    token = uuid.uuid4().hex
+    try:
+        for _ in range(FILL_WAIT_RETRIES):
+            if await redis_client.set(lock_key, token, nx=True, ex=FILL_LOCK_TTL):
+                return None, token
+            await asyncio.sleep(FILL_WAIT_INTERVAL)
+            cached = await redis_client.get(cache_key)
+            if cached:
+                return cached, None
+    except Exception as e:
+        logger.warning("Redis fill lock error: %s", e)
+    return None, None
+
+
+async def release_fill_lock(cache_key: str, token: Optional[str]):
+    """
+    释放 wait_for_cache_fill 获取的填充锁
+    """
+    if not token:
+        return
+    try:
+        await _release_lock_script(keys=[f"lock:{cache_key}"], args=[token])
+    except Exception as e:
+        logger.warning("Redis release lock error: %s", e)
 
 
 async def check_redis_connection() -> bool:
@@ -107,7 +311,7 @@ async def check_redis_connection() -> bool:
         await redis_client.ping()
         return True
     except Exception as e:
-        print(f"Redis connection error: {e}")
+        logger.warning("Redis connection error: %s", e)
         return False
 
 
@@ -0,0 +1,25 @@
+import pandas as pd
+
+from services.dataframe_service import FORMAT_PICKLE_OOB, dumps_dataframe, loads_dataframe, read_csv_file
+
+
+def test_read_csv_file_renames_duplicate_headers():
+    """重复表头与 pandas 一致重命名为 a, a.1，不报错"""
+    df = read_csv_file(b"a,a,b\n1,2,3\n")
+    assert df.columns.tolist() == ["a", "a.1", "b"]
+    assert df.iloc[0].tolist() == [1, 2, 3]
+
+
+def test_read_csv_file_duplicate_headers_from_path(tmp_path):
+    path = tmp_path / "dup.csv"
+    path.write_bytes(b"a,a,b\n1,2,3\n")
+    df = read_csv_file(str(path))
+    assert df.columns.tolist() == ["a", "a.1", "b"]
+
+
+def test_dumps_dataframe_falls_back_for_duplicate_columns():
+    """Arrow 拒绝的 DataFrame（重复列名）降级为 pickle，而不是抛出异常"""
+    df = pd.DataFrame([[1, 2]], columns=["a", "a"])
+    data = dumps_dataframe(df)
+    assert data[:1] == FORMAT_PICKLE_OOB
+    pd.testing.assert_frame_equal(loads_dataframe(data), df)